@@ -8,8 +8,9 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from logging.handlers import SMTPHandler, RotatingFileHandler
-from elasticsearch import Elasticsearch
 from redis import Redis
+from app.broker import RedisBroker, LocalBroker
+from app.search import make_search_index
 import os
 import logging
 import rq
@@ -42,12 +43,24 @@ def create_app(config_class=Config):
     moment.init_app(app)
     babel.init_app(app)
 
-    # Initialize elasticsearch
-    app.elasticsearch = Elasticsearch(app.config['ELASTICSEARCH_URL']) if app.config['ELASTICSEARCH_URL'] else None
+    # Initialize the full-text search backend
+    app.search_index = make_search_index(app.config)
 
     # Initialize Redis queue
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    # Initialize the broker that carries notifications to the notification streams of the users
+    app.broker = LocalBroker() if app.config['NOTIFICATION_BROKER'] == 'local' else RedisBroker(app.redis)
+    # Initialize the store of the version stamps behind the ETags of pages
+    from app.etags import RedisStamps, LocalStamps
+    app.stamps = LocalStamps() if app.config['ETAG_STAMPS'] == 'local' else RedisStamps()
+    # in-process stand-ins for the Redis-backed caches, used while Redis is unreachable
+    app.redis_down_until = 0
+    app.local_stores = {}
+
+    # report the number and duration of the SQL statements of each request, and log the slow ones
+    from app import instrumentation
+    instrumentation.init_app(app)
 
     # register the blueprint for authentication handling
     from app.auth import bp as auth_bp
@@ -61,6 +74,10 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    # make the cached rendering of post lists available to templates
+    from app.fragments import render_posts
+    app.add_template_global(render_posts)
+
     # create and add various loggers, and they won't be executed when debugging or testing
     if not app.debug and not app.testing:
         # create and add an email logger (for ERROR only) if the mail server has been configured
@@ -90,6 +107,12 @@ def create_app(config_class=Config):
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
 
+        # create and add a file logger for slow SQL statements
+        slow_query_handler = RotatingFileHandler('logs/slow_queries.log', maxBytes=1048576, backupCount=10)
+        slow_query_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        instrumentation.slow_query_logger.addHandler(slow_query_handler)
+        instrumentation.slow_query_logger.setLevel(logging.WARNING)
+
     return app
 
 
@@ -0,0 +1,110 @@
+import queue
+from collections import defaultdict
+from threading import Lock
+
+
+# the pattern of the Redis channels of the notifications of all users, 'notifications:<user id>'
+PATTERN = 'notifications:*'
+
+
+def _channel(user_id):
+    return 'notifications:{}'.format(user_id)
+
+
+class LocalBroker(object):
+    """
+    This class implements a broker that carries notifications within a single process, such as the tests, with a queue
+    for each subscription.
+    """
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = Lock()
+
+    def publish(self, user_id, message):
+        """This method sends a message to the subscribers of a user's notifications."""
+
+        self.deliver(user_id, message)
+
+    def deliver(self, user_id, message):
+        """This method puts a message in the queues of the subscriptions of this process to a user's notifications."""
+
+        with self.lock:
+            for subscription in self.subscriptions.get(user_id, ()):
+                subscription.queue.put(message)
+
+    def subscribe(self, user_id):
+        """This method returns a QueueSubscription to the notifications of a user."""
+
+        subscription = QueueSubscription(self, user_id)
+        with self.lock:
+            self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """This method ends a subscription."""
+
+        with self.lock:
+            self.subscriptions[subscription.user_id].discard(subscription)
+            if not self.subscriptions[subscription.user_id]:
+                del self.subscriptions[subscription.user_id]
+
+
+class RedisBroker(LocalBroker):
+    """
+    This class implements the broker that carries notifications from the processes that create them, web workers and
+    task workers alike, to the web workers that stream them to the browsers of their users, over Redis pub/sub. Each
+    web worker listens to the notifications of all users on a single pub/sub connection, in a background thread (a
+    greenlet under gevent), and hands them out to the queues of the streams it serves, however many they are.
+    """
+
+    def __init__(self, redis):
+        super().__init__()
+        self.redis = redis
+        self.listener = None
+        self.listener_lock = Lock()
+
+    def publish(self, user_id, message):
+        """This method sends a message to the subscribers of a user's notifications, in every process."""
+
+        self.redis.publish(_channel(user_id), message)
+
+    def subscribe(self, user_id):
+        """
+        This method returns a QueueSubscription to the notifications of a user, and makes sure that this process is
+        listening to the notifications, starting the listener again if it has died since, for instance because Redis
+        went away.
+        """
+
+        with self.listener_lock:
+            if self.listener is None or not self.listener.is_alive():
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(**{PATTERN: self._receive})
+                self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return super().subscribe(user_id)
+
+    def _receive(self, message):
+        user_id = int(message['channel'].decode('ascii').rsplit(':', 1)[1])
+        self.deliver(user_id, message['data'].decode('utf-8'))
+
+
+class QueueSubscription(object):
+    """This class implements a subscription to the notifications of a user, fed by a broker through a queue."""
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        """This method waits up to timeout seconds for the next message, and returns it, or None if none came."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """This method ends the subscription."""
+
+        self.broker.unsubscribe(self)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from flask import current_app
+
+
+def get_redis():
+    """
+    This function returns the app's Redis connection, or None while Redis is known to be unreachable, so that callers
+    can go straight to their in-process fallback instead of waiting on a dead connection for every call.
+    """
+
+    if time() < current_app.redis_down_until:
+        return None
+    return current_app.redis
+
+
+def redis_failed():
+    """This function flags Redis as unreachable for REDIS_RETRY_SECONDS, after a Redis call has raised an error."""
+
+    current_app.redis_down_until = time() + current_app.config['REDIS_RETRY_SECONDS']
+    current_app.logger.warning('Redis is unreachable, using in-process fallbacks for {} seconds'.format(
+        current_app.config['REDIS_RETRY_SECONDS']))
+
+
+def local_store(name, factory=dict):
+    """
+    This function returns a named in-process data structure attached to the app, creating it with the given factory
+    on first use. These structures stand in for Redis when it is not reachable, or cache in front of it, and are
+    private to each worker process.
+    """
+
+    if name not in current_app.local_stores:
+        current_app.local_stores[name] = factory()
+    return current_app.local_stores[name]
+
+
+class LRUCache(object):
+    """
+    This class implements a bounded, thread-safe in-process cache, which evicts the least recently used entries once it
+    holds maxsize entries. Entries also expire after ttl seconds if a ttl is given, which bounds how long a worker can
+    serve an entry that was invalidated by another worker.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """This method returns the value cached for a key, or the default if there is none or it has expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """This method caches a value for a key, evicting the least recently used entry if the cache is full."""
+
+        with self._lock:
+            self._entries[key] = (value, time() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """This method drops the value cached for a key, if any."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """This method drops all the cached values."""
+
+        with self._lock:
+            self._entries.clear()
@@ -1,8 +1,16 @@
 import os
 import click
+from flask import current_app
+from app import db
+from app.models import User, SearchableMixin
+from app.maintenance import compact as compact_tables, schedule_compaction
+from app.translate import translation_metrics
 
 def register(app):
-    """This function registers commands for the command group 'flask translate'."""
+    """
+    This function registers commands for the command groups 'flask translate', 'flask counters', 'flask maintenance'
+    and 'flask search'.
+    """
 
     @app.cli.group()
     def translate():
@@ -40,3 +48,76 @@ def register(app):
 
         if os.system("pybabel compile -d app/translations"):
             raise RuntimeError("compile command failed")
+
+
+    @translate.command()
+    def stats():
+        """Show the hits and misses of the translation cache."""
+
+        click.echo('Redis hits: {redis_hits}, store hits: {store_hits}, misses: {misses}, errors: {errors}.'.format(
+            **translation_metrics()))
+
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter maintenance commands."""
+
+        pass
+
+
+    @counters.command()
+    def reconcile():
+        """Recompute the follower, following, post and unread message counters of all users."""
+
+        fixed = User.reconcile_counters()
+        db.session.commit()
+        click.echo('Fixed the counters of {} users.'.format(fixed))
+
+
+    @app.cli.group()
+    def maintenance():
+        """Database maintenance commands."""
+
+        pass
+
+
+    @maintenance.command()
+    def compact():
+        """Delete the completed tasks and the notifications past their retention period."""
+
+        click.echo('Removed {tasks} tasks and {notifications} notifications in {seconds:.3f} s.'.format(
+            **compact_tables()))
+
+
+    @maintenance.command()
+    def schedule():
+        """Start the periodic compaction job, unless it is already scheduled."""
+
+        if schedule_compaction():
+            click.echo('Scheduled the compaction job.')
+        else:
+            click.echo('The compaction job is already scheduled, or Redis is unreachable.')
+
+
+    @app.cli.group()
+    def search():
+        """Full-text search index commands."""
+
+        pass
+
+
+    @search.command()
+    @click.option('--workers', type=int, help='Number of threads sending bulk requests.')
+    @click.option('--batch-size', type=int, help='Number of rows read and indexed at a time.')
+    @click.option('--restart', is_flag=True, help='Discard an interrupted rebuild instead of resuming it.')
+    def reindex(workers, batch_size, restart):
+        """Rebuild the search indexes into new indexes, and swap them in when done."""
+
+        for model in SearchableMixin.__subclasses__():
+            def progress(indexed, total):
+                click.echo('\r{}: {}/{}'.format(model.__tablename__, indexed, total), nl=False)
+
+            indexed = model.reindex(workers or current_app.config['SEARCH_REINDEX_WORKERS'],
+                                    batch_size or current_app.config['SEARCH_REINDEX_BATCH_SIZE'],
+                                    restart=restart, progress=progress)
+            click.echo('\rIndexed {} objects into {}.'.format(indexed, model.__tablename__))
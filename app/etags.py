@@ -0,0 +1,170 @@
+from hashlib import md5
+from threading import Lock
+from time import time
+from flask import current_app, request, session, g, make_response
+from flask_login import current_user
+from redis.exceptions import RedisError
+from app import db
+from app.cache import get_redis, redis_failed
+
+
+# Version stamps are the times of the last committed change to some part of the data, kept in Redis as 'stamp:<name>'
+# keys. The stamps in use are:
+#   posts                  any post created or deleted
+#   user:<id>              the user, or what the base template shows of the user: new messages and running tasks
+#   profile:<username>     what the profile page of a user shows of that user
+#   notifications:<id>     the notifications of the user
+# A stamp that is missing from Redis is started at the current time, and stamps expire after ETAG_STAMP_TTL seconds,
+# so that a change missed while Redis was unreachable does not keep pages from being served again forever. The stamps
+# are kept by app.stamps, a RedisStamps, or a LocalStamps within a single process such as the tests.
+
+
+def _key(name):
+    return 'stamp:{}'.format(name)
+
+
+class RedisStamps(object):
+    """This class implements the store of the version stamps in Redis, shared by all the workers."""
+
+    def get(self, names):
+        """
+        This method returns the version stamps of the given names, as a list of strings. It returns None while Redis is
+        unreachable, as version stamps kept by each worker on its own could miss the changes made through other
+        workers.
+        """
+
+        r = get_redis()
+        if r is None:
+            return None
+        try:
+            pipe = r.pipeline(transaction=False)
+            for name in names:
+                pipe.set(_key(name), repr(time()), ex=current_app.config['ETAG_STAMP_TTL'], nx=True)
+                pipe.get(_key(name))
+            return [stamp.decode('utf-8') for stamp in pipe.execute()[1::2]]
+        except RedisError:
+            redis_failed()
+            return None
+
+    def bump(self, names):
+        """This method moves the version stamps of the given names to the current time."""
+
+        r = get_redis()
+        if r is None:
+            return
+        try:
+            pipe = r.pipeline(transaction=False)
+            for name in names:
+                pipe.set(_key(name), repr(time()), ex=current_app.config['ETAG_STAMP_TTL'])
+            pipe.execute()
+        except RedisError:
+            redis_failed()
+
+
+class LocalStamps(object):
+    """
+    This class implements a store of version stamps that stands in for RedisStamps within a single process, such as the
+    tests, with a dictionary of the stamps.
+    """
+
+    def __init__(self):
+        self.stamps = {}
+        self.lock = Lock()
+
+    def get(self, names):
+        """This method returns the version stamps of the given names, as a list of strings."""
+
+        with self.lock:
+            return [self.stamps.setdefault(name, repr(time())) for name in names]
+
+    def bump(self, names):
+        """This method moves the version stamps of the given names to the current time."""
+
+        with self.lock:
+            for name in names:
+                # later than the previous stamp, even if the clock has not moved on since
+                self.stamps[name] = repr(max(time(), float(self.stamps.get(name, 0)) + 1e-6))
+
+
+def get_stamps(names):
+    """
+    This function returns the version stamps of the given names, as a list of strings, or None if they cannot be read.
+    """
+
+    return current_app.stamps.get(names)
+
+
+def bump_stamps(names):
+    """This function moves the version stamps of the given names to the current time."""
+
+    if names:
+        current_app.stamps.bump(names)
+
+
+def touch(db_session, *names):
+    """This function records version stamps to be bumped once the current transaction of the session is committed."""
+
+    db_session.info.setdefault('stamps', set()).update(names)
+
+
+def after_commit(db_session):
+    """This function bumps the version stamps touched in a transaction that has just been committed."""
+
+    bump_stamps(db_session.info.pop('stamps', ()))
+
+
+def after_rollback(db_session):
+    """This function discards the version stamps touched in a transaction that has been rolled back."""
+
+    db_session.info.pop('stamps', None)
+
+
+# set up event handlers that bump the version stamps touched in a transaction after it is committed
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+def make_etag(*names):
+    """
+    This function builds a weak ETag for the response to the current request, from the version stamps of the given
+    names. See etag_from_stamps().
+    """
+
+    return etag_from_stamps(get_stamps(names))
+
+
+def etag_from_stamps(stamps):
+    """
+    This function builds a weak ETag for the response to the current request, from the given version stamps, the
+    current user and locale, and the request URL. It returns None if the response must not be answered with a 304,
+    which is the case when the stamps are missing because Redis is unreachable, or when a flashed message is waiting to
+    be shown.
+    """
+
+    if stamps is None or session.get('_flashes'):
+        return None
+    # pages embed CSRF tokens, so they are not reused for more than half the time these tokens are valid for
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 3600
+    parts = [request.full_path, str(current_user.get_id()), g.get('locale', ''), str(int(time() // (time_limit / 2)))]
+    return md5('\n'.join(parts + stamps).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    """This function returns a 304 Not Modified response if the client already holds the given ETag, or None."""
+
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    response = make_response('', 304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def with_etag(response, etag):
+    """This function adds the given weak ETag to a response, which clients must revalidate before reusing."""
+
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
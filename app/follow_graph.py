@@ -0,0 +1,81 @@
+from flask import current_app
+from redis.exceptions import RedisError, WatchError
+from app.cache import get_redis, redis_failed, local_store, LRUCache
+
+
+# a user id that never exists, stored in every cached set so that users who follow nobody still have a set in Redis
+SENTINEL = 0
+
+
+def _key(user_id):
+    return 'followed:{}'.format(user_id)
+
+
+def _version_key(user_id):
+    # bumped by every invalidation, so that a set loaded from the database before an invalidation is not cached after it
+    return 'followed:{}:version'.format(user_id)
+
+
+def _lru():
+    return local_store('follow_graph', lambda: LRUCache(current_app.config['FOLLOW_GRAPH_CACHE_SIZE'],
+                                                        current_app.config['FOLLOW_GRAPH_CACHE_TTL']))
+
+
+def get_followed_ids(user_id, load):
+    """
+    This function returns the set of ids of the users followed by a user. It is read from the in-process LRU cache,
+    then from the user's set in Redis, and finally from the database by calling load(), filling the cache tiers it
+    missed on the way back. The set is only written to Redis if the follows of the user have not been invalidated since
+    it was looked up there.
+    """
+
+    followed_ids = _lru().get(user_id)
+    if followed_ids is not None:
+        return followed_ids
+
+    r = get_redis()
+    if r is None:
+        followed_ids = frozenset(load())
+        _lru().set(user_id, followed_ids)
+        return followed_ids
+
+    try:
+        with r.pipeline() as pipe:
+            pipe.watch(_version_key(user_id))
+            members = pipe.smembers(_key(user_id))
+            if members:
+                followed_ids = frozenset(int(member) for member in members) - {SENTINEL}
+            else:
+                followed_ids = frozenset(load())
+                pipe.multi()
+                pipe.sadd(_key(user_id), SENTINEL, *followed_ids)
+                pipe.expire(_key(user_id), current_app.config['FOLLOW_GRAPH_REDIS_TTL'])
+                pipe.execute()
+    except WatchError:
+        # the follows changed while they were being loaded, so the set loaded may be out of date, and is not cached
+        return followed_ids
+    except RedisError:
+        redis_failed()
+        if followed_ids is None:
+            followed_ids = frozenset(load())
+
+    _lru().set(user_id, followed_ids)
+    return followed_ids
+
+
+def invalidate_followed_ids(user_ids):
+    """This function drops the cached sets of followed users of the given users, after their follows changed."""
+
+    for user_id in user_ids:
+        _lru().delete(user_id)
+    r = get_redis()
+    if r is not None and user_ids:
+        try:
+            pipe = r.pipeline()
+            pipe.delete(*[_key(user_id) for user_id in user_ids])
+            for user_id in user_ids:
+                pipe.incr(_version_key(user_id))
+                pipe.expire(_version_key(user_id), current_app.config['FOLLOW_GRAPH_REDIS_TTL'])
+            pipe.execute()
+        except RedisError:
+            redis_failed()
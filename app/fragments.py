@@ -0,0 +1,94 @@
+from hashlib import md5
+from flask import current_app, render_template, g
+from markupsafe import Markup
+from redis.exceptions import RedisError
+from app.cache import get_redis, redis_failed, local_store, LRUCache
+from app.etags import get_stamps
+
+
+def _lru():
+    return local_store('post_fragments', lambda: LRUCache(current_app.config['POST_FRAGMENT_CACHE_SIZE'],
+                                                          current_app.config['POST_FRAGMENT_CACHE_TTL']))
+
+
+def _key(post):
+    # The profile version of the author is a digest of the author fields shown in the fragment, so that the cached
+    # fragments of a user are left behind as soon as the user changes username or email (which the avatar is
+    # derived from). The locale picks the language of the fragment and whether it has a translate link.
+    version = md5('{}\n{}'.format(post.author.username, post.author.email or '').encode('utf-8')).hexdigest()[:12]
+    return 'fragment:post:{}:{}:{}'.format(post.id, g.locale, version)
+
+
+def render_posts(posts):
+    """
+    This function renders _post.html for each of the given posts, and returns the concatenated markup. The rendered
+    fragments are cached in an in-process LRU cache, backed by Redis, so that the fragments of all the posts of a page
+    are looked up with a single Redis call and only the missing ones are rendered.
+    """
+
+    keys = [_key(post) for post in posts]
+    fragments = {key: _lru().get(key) for key in keys}
+    missing = [key for key in keys if fragments[key] is None]
+
+    r = get_redis()
+    if r is not None and missing:
+        try:
+            for key, fragment in zip(missing, r.mget(missing)):
+                if fragment is not None:
+                    fragments[key] = fragment.decode('utf-8')
+                    _lru().set(key, fragments[key])
+        except RedisError:
+            redis_failed()
+            r = None
+
+    rendered = {}
+    for key, post in zip(keys, posts):
+        if fragments[key] is None:
+            fragments[key] = rendered[key] = render_template('_post.html', post=post)
+            _lru().set(key, fragments[key])
+    if r is not None and rendered:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for key, fragment in rendered.items():
+                pipe.set(key, fragment, ex=current_app.config['POST_FRAGMENT_REDIS_TTL'])
+            pipe.execute()
+        except RedisError:
+            redis_failed()
+
+    # the fragments were rendered with autoescaping, so they are safe to insert as they are
+    return Markup(''.join(fragments[key] for key in keys))
+
+
+def render_user_popup(user):
+    """
+    This function renders the part of the popup of a user that is the same for all viewers, and returns the markup.
+    The markup is cached in each worker and in Redis under the version stamp of the user's profile (see
+    app/etags.py), which is bumped when the user edits the profile, follows or is followed, so that stale popups are
+    never served. Nothing is cached while Redis is unreachable, as the version stamps are kept there.
+    """
+
+    stamps = get_stamps(['profile:{}'.format(user.username)])
+    if stamps is None:
+        return Markup(render_template('_user_popup.html', user=user))
+
+    key = 'fragment:popup:{}:{}:{}'.format(user.username, g.locale, stamps[0])
+    lru = local_store('popup_fragments', lambda: LRUCache(current_app.config['POPUP_FRAGMENT_CACHE_SIZE'],
+                                                          current_app.config['POPUP_FRAGMENT_CACHE_TTL']))
+    popup = lru.get(key)
+    r = get_redis()
+    if popup is None and r is not None:
+        try:
+            cached = r.get(key)
+            popup = cached.decode('utf-8') if cached is not None else None
+        except RedisError:
+            redis_failed()
+            r = None
+    if popup is None:
+        popup = render_template('_user_popup.html', user=user)
+        if r is not None:
+            try:
+                r.set(key, popup, ex=current_app.config['POPUP_FRAGMENT_REDIS_TTL'])
+            except RedisError:
+                redis_failed()
+    lru.set(key, popup)
+    return Markup(popup)
@@ -0,0 +1,89 @@
+import heapq
+import logging
+import re
+from time import perf_counter
+from flask import g, request, current_app, has_request_context
+from app import db
+
+
+# the logger of the statements that take longer than SQL_SLOW_QUERY_MS, which create_app() sends to a dedicated file
+slow_query_logger = logging.getLogger('microblog.slow_queries')
+
+
+def _elide(statement):
+    """This function collapses the whitespace and the lists of parameter placeholders of a SQL statement."""
+
+    statement = ' '.join(statement.split())
+    return re.sub(r'\((?:\?|%s|%\(\w+\)s)(?:, (?:\?|%s|%\(\w+\)s))*\)', '(...)', statement)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    This function records the start time of a statement, before the engine executes it. The time is kept on the
+    execution context of the statement, which is dropped along with it if the statement fails.
+    """
+
+    context.query_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    This function adds a statement that has just been executed to the statistics of the current request, and writes it
+    to the slow query log if it took at least SQL_SLOW_QUERY_MS milliseconds. Parameters are never recorded.
+    """
+
+    elapsed = (perf_counter() - context.query_start) * 1000
+    endpoint = request.endpoint if has_request_context() else None
+    if elapsed >= current_app.config['SQL_SLOW_QUERY_MS']:
+        slow_query_logger.warning('%.1f ms [%s] %s', elapsed, endpoint or 'no request', _elide(statement))
+
+    stats = g.get('sql_stats') if has_request_context() else None
+    if stats is not None:
+        stats['count'] += 1
+        stats['duration'] += elapsed
+        # a min-heap of the slowest statements, keyed by their duration and their order of execution
+        entry = (elapsed, stats['count'], statement)
+        if len(stats['slowest']) < current_app.config['SQL_SLOWEST_COUNT']:
+            heapq.heappush(stats['slowest'], entry)
+        else:
+            heapq.heappushpop(stats['slowest'], entry)
+
+
+def before_request():
+    """This function starts the SQL statistics of a request."""
+
+    g.sql_stats = {'count': 0, 'duration': 0.0, 'slowest': []}
+
+
+def after_request(response):
+    """
+    This function reports the SQL statistics of the request in a Server-Timing header, which shows up in the network
+    panel of the browser's developer tools, and in a one-line summary logged at SQL_STATS_LOG_LEVEL. The slowest
+    statements are added to the debug log.
+    """
+
+    stats = g.get('sql_stats')
+    if stats is None:
+        return response
+    response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(stats['duration'],
+                                                                                 stats['count']))
+    current_app.logger.log(logging.getLevelName(current_app.config['SQL_STATS_LOG_LEVEL']),
+                           '%s %s %d: %d queries in %.1f ms', request.method, request.endpoint, response.status_code,
+                           stats['count'], stats['duration'])
+    if stats['slowest'] and current_app.logger.isEnabledFor(logging.DEBUG):
+        current_app.logger.debug('%s: slowest queries: %s', request.endpoint, '; '.join(
+            '{:.1f} ms {}'.format(elapsed, _elide(statement))
+            for elapsed, _, statement in sorted(stats['slowest'], reverse=True)))
+    return response
+
+
+def init_app(app):
+    """This function hooks the instrumentation into the database engine and the requests of the given app."""
+
+    with app.app_context():
+        engine = db.get_engine()
+    if not db.event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        db.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(before_request)
+    app.after_request(after_request)
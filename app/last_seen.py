@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+from flask import current_app
+from redis.exceptions import RedisError
+from app import db
+from app.cache import get_redis, redis_failed, local_store, LRUCache
+from app.etags import bump_stamps
+from app.models import User
+
+
+# the Redis hash buffering the last_seen times not yet written to the database, keyed by user id
+_KEY = 'last_seen'
+# set while a flush_last_seen job is scheduled on the task queue
+_SCHEDULED_KEY = 'last_seen:scheduled'
+
+_lock = Lock()
+
+
+def _recorded():
+    # the last time recorded for each user by this worker, so that requests within LAST_SEEN_GRANULARITY are skipped
+    # without a round trip to Redis
+    return local_store('last_seen_recorded', lambda: LRUCache(current_app.config['LAST_SEEN_CACHE_SIZE'],
+                                                              current_app.config['LAST_SEEN_GRANULARITY']))
+
+
+def _buffer():
+    # the in-process buffer used without Redis, with the time it was last flushed
+    return local_store('last_seen', lambda: {'updates': {}, 'flushed': time()})
+
+
+def record_last_seen(user_id, timestamp, previous=None):
+    """
+    This function records that a user was seen at the given time, in a buffer that is written to the database in bulk
+    by flush_last_seen(). Nothing is recorded if the previous last_seen time of the user, or the time last recorded by
+    this worker, is less than LAST_SEEN_GRANULARITY seconds older. It returns whether the time was recorded.
+    """
+
+    recorded = _recorded().get(user_id)
+    if recorded is None or (previous is not None and previous > recorded):
+        recorded = previous
+    if recorded is not None and timestamp - recorded < timedelta(seconds=current_app.config['LAST_SEEN_GRANULARITY']):
+        return False
+    _recorded().set(user_id, timestamp)
+
+    r = get_redis()
+    if r is not None:
+        try:
+            r.hset(_KEY, user_id, timestamp.isoformat())
+            _schedule_flush(r)
+            return True
+        except RedisError:
+            redis_failed()
+
+    # without Redis, each worker buffers its own updates and flushes them itself once the flush interval has passed
+    with _lock:
+        _buffer()['updates'][user_id] = timestamp
+        flush_due = time() >= _buffer()['flushed'] + current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    if flush_due:
+        flush_last_seen()
+    return True
+
+
+def _schedule_flush(r):
+    """This function schedules a flush_last_seen job on the task queue, unless one is already scheduled."""
+
+    interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    if r.set(_SCHEDULED_KEY, 1, nx=True, ex=interval):
+        current_app.task_queue.enqueue_in(timedelta(seconds=interval), 'app.tasks.flush_last_seen')
+
+
+def _take_buffered():
+    """This function empties the buffers of last_seen times and returns their contents, as a dict by user id."""
+
+    updates = {}
+    r = get_redis()
+    if r is not None:
+        try:
+            pipe = r.pipeline()
+            pipe.hgetall(_KEY)
+            pipe.delete(_KEY, _SCHEDULED_KEY)
+            entries, _ = pipe.execute()
+            updates = {int(user_id): datetime.fromisoformat(timestamp.decode('utf-8'))
+                       for user_id, timestamp in entries.items()}
+        except RedisError:
+            redis_failed()
+
+    with _lock:
+        for user_id, timestamp in _buffer()['updates'].items():
+            if user_id not in updates or timestamp > updates[user_id]:
+                updates[user_id] = timestamp
+        _buffer()['updates'] = {}
+        _buffer()['flushed'] = time()
+    return updates
+
+
+def flush_last_seen():
+    """
+    This function writes the buffered last_seen times to the database with a single bulk UPDATE, and returns the number
+    of users updated.
+    """
+
+    updates = _take_buffered()
+    if updates:
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == db.bindparam('user_id')).values(
+            last_seen=db.bindparam('timestamp')),
+            [{'user_id': user_id, 'timestamp': timestamp} for user_id, timestamp in updates.items()])
+        db.session.commit()
+        # profile pages show the last_seen times
+        bump_stamps(['profile:{}'.format(username) for username, in
+                     db.session.query(User.username).filter(User.id.in_(updates))])
+    return len(updates)
@@ -1,13 +1,22 @@
-from flask import current_app, render_template, flash, redirect, url_for, request, g, jsonify
+from flask import current_app, render_template, flash, redirect, url_for, request, g, jsonify, make_response, abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 from datetime import datetime 
+from time import time
+import json
 from guess_language import guess_language
+from redis.exceptions import RedisError
 from app import db
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Message, Notification, load_authors
 from app.translate import translate
+from app.pagination import get_page_args, keyset_paginate, decode_search_cursor
+from app.last_seen import record_last_seen
+from app.fragments import render_user_popup
+from app.suggest import suggest
+from app.cache import redis_failed
+from app.etags import get_stamps, make_etag, etag_from_stamps, not_modified, with_etag
 
 
 @bp.before_request
@@ -18,8 +27,11 @@ def before_request():
     """
 
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # buffered and written to the database in bulk, instead of an UPDATE and a commit on every request, and
+        # compared to the last_seen time of the user only if it is loaded, as it is left out of cached users
+        previous = None if 'last_seen' in db.inspect(current_user._get_current_object()).unloaded \
+            else current_user.last_seen
+        record_last_seen(current_user.id, datetime.utcnow(), previous)
         g.search_form = SearchForm()
 
     # For any request, add to the g object the selected language returned by Flask-Babel via the get_locale() function.
@@ -53,14 +65,21 @@ def index():
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
 
-    page = request.args.get('page', 1, type=int)
-    # The paginate() call returns an object of the Paginate class.
-    # The items attribute of this object contains the list of items retrieved for the selected page.
-    posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    # Answer with a 304 if the client's copy of the page is still current, going by the version stamps of the data.
+    etag = make_etag('posts', 'user:{}'.format(current_user.id)) if request.method == 'GET' else None
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # The posts are read from the precomputed home timeline of the user, one page of post ids at a time.
+    # Pages are addressed by opaque cursors to the posts around them, instead of page numbers.
+    posts = current_user.timeline(current_app.config['POSTS_PER_PAGE'], **get_page_args())
+    load_authors(posts.items)
+    next_url = url_for('main.index', after=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.index', before=posts.prev_cursor) if posts.has_prev else None
 
-    return render_template('index.html', title='Home', posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    return with_etag(render_template('index.html', title='Home', posts=posts.items, form=form, next_url=next_url,
+                                     prev_url=prev_url), etag)
 
 
 @bp.route('/user/<username>')
@@ -68,24 +87,37 @@ def index():
 def user(username):
     """This function provides a view for the profile of the logged in user."""
 
+    etag = make_etag('posts', 'user:{}'.format(current_user.id), 'profile:{}'.format(username))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None 
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None 
+    posts = keyset_paginate(user.posts, Post, current_app.config['POSTS_PER_PAGE'], **get_page_args())
+    load_authors(posts.items)
+    next_url = url_for('main.user', username=user.username, after=posts.next_cursor) if posts.has_next else None 
+    prev_url = url_for('main.user', username=user.username, before=posts.prev_cursor) if posts.has_prev else None 
     form = EmptyForm()
 
-    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url, form=form)
+    return with_etag(render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url,
+                                     form=form), etag)
 
 
 @bp.route('/user/<username>/popup')
 def user_popup(username):
     """This view function renders user info on a popup window."""
 
+    # The part of the popup shared by all viewers is cached, and only the follow button is rendered for each viewer.
+    # Browsers may reuse the popup for USER_POPUP_MAX_AGE seconds.
     user = User.query.filter_by(username=username).first_or_404()
+    popup = render_user_popup(user)
+    following = current_user.is_authenticated and user.id in current_user.followed_ids()
     form = EmptyForm()
 
-    return render_template('user_popup.html', user=user, form=form)
+    response = make_response(render_template('user_popup.html', user_id=user.id, username=username, popup=popup,
+                                             following=following, form=form))
+    response.headers['Cache-Control'] = 'private, max-age={}'.format(current_app.config['USER_POPUP_MAX_AGE'])
+    return response
 
 
 @bp.route('/edit_profile', methods=['POST', 'GET'])
@@ -154,14 +186,20 @@ def unfollow(username):
 def explore():
     """This function handles requests to explore all user posts."""
 
-    page = request.args.get('page', 1, type=int)
-    # The paginate() call returns an object of the Paginate class.
+    etag = make_etag('posts', 'user:{}'.format(current_user.id))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # The explore() call returns a KeysetPage object, read from the global timeline shared by all users.
     # The items attribute of this object contains the list of items retrieved for the selected page.
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    posts = Post.explore(current_app.config['POSTS_PER_PAGE'], **get_page_args())
+    load_authors(posts.items)
+    next_url = url_for('main.explore', after=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.explore', before=posts.prev_cursor) if posts.has_prev else None
 
-    return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return with_etag(render_template('index.html', title='Explore', posts=posts.items, next_url=next_url,
+                                     prev_url=prev_url), etag)
 
 
 @bp.route('/translate', methods=['POST'])
@@ -186,20 +224,34 @@ def search():
     # redirect to 'explore' if search form is empty
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    # get page number and run search
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, 
-                               current_app.config['POSTS_PER_PAGE'])
-    # set up pagination
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page+1) \
-        if page * current_app.config['POSTS_PER_PAGE'] < total else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page-1) \
-        if page > 1 else None
+    # run search, from the page cursor or page number
+    posts = Post.search(g.search_form.q.data, current_app.config['POSTS_PER_PAGE'],
+                        after=decode_search_cursor(request.args.get('after')),
+                        before=decode_search_cursor(request.args.get('before')),
+                        page=request.args.get('page', type=int))
+    # set up pagination, with cursors made of the sort values of the first and last hits
+    next_url = url_for('main.search', q=g.search_form.q.data, after=posts.next_cursor) \
+        if posts.has_next else None
+    prev_url = url_for('main.search', q=g.search_form.q.data, before=posts.prev_cursor) \
+        if posts.has_prev else None
     # return
-    return render_template('search.html', title='Search', posts=posts,
+    return render_template('search.html', title='Search', posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/search/suggest')
+@login_required
+def search_suggest():
+    """
+    This function answers search-as-you-type requests with the usernames and the post terms that start like the
+    query, from the in-memory prefix indexes of this worker.
+    """
+
+    response = jsonify(suggest(request.args.get('q', ''), current_app.config['SUGGEST_LIMIT']))
+    response.headers['Cache-Control'] = 'private, max-age={}'.format(current_app.config['SUGGEST_MAX_AGE'])
+    return response
+
+
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
@@ -211,6 +263,8 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user, 
                       body=form.message.data)
         db.session.add(msg)
+        # the flush counts the message in the unread message counter of the recipient
+        db.session.flush()
         user.add_notification(name='unread_message_count', 
                               data=user.new_messages())
         db.session.commit()
@@ -227,16 +281,17 @@ def messages():
     """This view function handles requests to view received messages."""
 
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_message_count = 0
     current_user.add_notification(name='unread_message_count', data=0)
     db.session.commit()
 
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(page, 
-        current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
+    messages = keyset_paginate(current_user.messages_received, Message, 
+                               current_app.config['POSTS_PER_PAGE'], 
+                               **get_page_args())
+    load_authors(messages.items)
+    next_url = url_for('main.messages', after=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', before=messages.prev_cursor) \
         if messages.has_prev else None
     
     return render_template('messages.html', title='Messages', 
@@ -250,13 +305,67 @@ def notifications():
     """This view function handles Ajax requests to fetch notifications."""
 
     since = request.args.get('since', 1.0, type=float)
+    stamps = get_stamps(['notifications:{}'.format(current_user.id)])
+    etag = etag_from_stamps(stamps)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # nothing can be newer than since if the notifications of the user have not changed since then
+    if stamps is not None and float(stamps[0]) <= since:
+        return with_etag(jsonify([]), etag)
     notifications = current_user.notifications.filter(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp 
-        } for n in notifications])
+    return with_etag(jsonify([n.to_dict() for n in notifications]), etag)
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    """
+    This view function streams the notifications of the user as Server-Sent Events. The stream starts with the
+    notifications newer than the Last-Event-ID header sent by reconnecting browsers, or the since argument, and then
+    forwards the notifications published to the user until NOTIFICATION_STREAM_TIMEOUT, when browsers reconnect.
+    Streams are meant to be served by an async worker class, which holds idle connections without a thread each.
+    """
+
+    since = request.headers.get('Last-Event-ID', type=float) or request.args.get('since', 0.0, type=float)
+    # subscribe before reading the newer notifications, so that none gets lost in between, and leave browsers to poll
+    # if the broker is unreachable
+    try:
+        subscription = current_app.broker.subscribe(current_user.id)
+    except RedisError:
+        redis_failed()
+        abort(503)
+    notifications = [n.to_dict() for n in current_user.notifications.filter(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    keepalive = current_app.config['NOTIFICATION_STREAM_KEEPALIVE']
+
+    def event(message):
+        return 'id: {}\nevent: notification\ndata: {}\n\n'.format(json.loads(message)['timestamp'], message)
+
+    def stream():
+        try:
+            latest = since
+            for n in notifications:
+                latest = n['timestamp']
+                yield event(json.dumps(n))
+            deadline = time() + timeout
+            while time() < deadline:
+                message = subscription.get(timeout=min(keepalive, max(deadline - time(), 0)))
+                if message is None:
+                    yield ': keepalive\n\n'
+                    continue
+                timestamp = json.loads(message)['timestamp']
+                if timestamp > latest:
+                    latest = timestamp
+                    yield event(message)
+        finally:
+            subscription.close()
+
+    return current_app.response_class(stream(), mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @bp.route('/export_posts')
@@ -0,0 +1,45 @@
+from datetime import timedelta
+from time import time
+from flask import current_app
+from redis.exceptions import RedisError
+from app.cache import get_redis, redis_failed
+from app.models import Task, Notification
+
+
+# set while a compact job is scheduled on the task queue; it outlives the wait for the job, so that a new job is only
+# scheduled once the previous chain of jobs has stopped
+_SCHEDULED_KEY = 'compaction:scheduled'
+
+
+def compact():
+    """
+    This function deletes the tasks completed more than TASK_RETENTION_DAYS ago and the notifications not updated for
+    NOTIFICATION_RETENTION_DAYS, COMPACTION_BATCH_SIZE rows at a time. It returns a report of the number of tasks and
+    notifications deleted and the number of seconds it took.
+    """
+
+    start = time()
+    batch_size = current_app.config['COMPACTION_BATCH_SIZE']
+    tasks = Task.purge_completed(start - current_app.config['TASK_RETENTION_DAYS'] * 86400, batch_size)
+    notifications = Notification.purge_expired(start - current_app.config['NOTIFICATION_RETENTION_DAYS'] * 86400,
+                                               batch_size)
+    return {'tasks': tasks, 'notifications': notifications, 'seconds': time() - start}
+
+
+def schedule_compaction(reschedule=False):
+    """
+    This function schedules a compact job on the task queue to run in COMPACTION_INTERVAL seconds, unless one is
+    already scheduled, or reschedule is set by the job itself. It returns whether a job was scheduled.
+    """
+
+    interval = current_app.config['COMPACTION_INTERVAL']
+    r = get_redis()
+    if r is None:
+        return False
+    try:
+        if r.set(_SCHEDULED_KEY, 1, nx=not reschedule, ex=2 * interval):
+            current_app.task_queue.enqueue_in(timedelta(seconds=interval), 'app.tasks.compact')
+            return True
+    except RedisError:
+        redis_failed()
+    return False
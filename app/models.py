@@ -1,4 +1,6 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import current_app
 from flask_login import UserMixin
@@ -6,9 +8,41 @@ from hashlib import md5
 from time import time
 import jwt 
 import json
+import heapq
 import rq, redis
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from app import db, login 
-from app.search import query_index, add_to_index, remove_from_index 
+from app.search import BACKEND_ERRORS, cached_query_index, search_document, bulk_index, bump_generations, \
+    create_index, delete_index, swap_alias
+from app.timeline import GLOBAL, timestamp_score, add_to_timelines, backfill_timeline, remove_from_timelines, \
+    set_timeline, clear_timeline, get_timeline
+from app.pagination import KeysetPage, SearchPage, keyset_query, keyset_paginate
+from app.follow_graph import get_followed_ids, invalidate_followed_ids
+from app.cache import get_redis, redis_failed, local_store, LRUCache
+from app.etags import touch
+from app.user_cache import load_cached_user, invalidate_users
+
+
+def delete_in_batches(model, criterion, batch_size, *columns):
+    """
+    This function deletes the rows of a model that match the given criterion, batch_size rows at a time, and commits
+    each batch in its own transaction, so that no lock is held for long. Each batch is yielded before it is committed,
+    as a list of (id, *columns) rows, for the caller to act on in the same transaction.
+    """
+
+    while True:
+        rows = db.session.query(model.id, *columns).filter(criterion).limit(batch_size).all()
+        if rows:
+            model.query.filter(model.id.in_([row[0] for row in rows])).delete(synchronize_session=False)
+            yield rows
+            db.session.commit()
+        if len(rows) < batch_size:
+            return
 
 
 class SearchableMixin(object):
@@ -18,67 +52,264 @@ class SearchableMixin(object):
     """
 
     @classmethod
-    def search(cls, expression, page, per_page):
-        """Class method to do full-text search and return a list of data objects."""
-
-        # search, and return id's of objects in the search results & the total number of search results
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        # return null values if the search did not return any results
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        # return objects in the same order returned by the search, and the total number of search results
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+    def search(cls, expression, per_page, after=None, before=None, page=None):
+        """
+        Class method to do full-text search and return a SearchPage of data objects, right after or right before the
+        sort values of a hit, or at a page number, along with the total number of hits.
+        """
+
+        # search, and return the id's and sort values of the hits, whether there are more, and the total number of hits
+        hits, more, total = cached_query_index(cls.__tablename__, expression, per_page, after=after, before=before,
+                                               page=page)
+        # fetch the objects by primary key, and put them in the order of the hits, skipping the objects deleted since
+        # they were indexed
+        objs = {obj.id: obj for obj in cls.query.filter(cls.id.in_([id for id, _ in hits]))} if hits else {}
+        hits = [(objs[id], sort_values) for id, sort_values in hits if id in objs]
+        # load the authors of all the objects at once, if the objects have authors
+        if 'author' in db.inspect(cls).relationships:
+            load_authors([obj for obj, _ in hits])
+        if before is not None:
+            return SearchPage(hits, total, has_next=True, has_prev=more)
+        if after is not None:
+            return SearchPage(hits, total, has_next=more, has_prev=True)
+        return SearchPage(hits, total, has_next=more, has_prev=bool(page and page > 1))
 
     @classmethod
-    def before_commit(cls, session):
+    def after_flush(cls, session, flush_context):
         """
-        Class method to save db session changes before committing, so that the same changes can be applied to the search 
-        index after successfully committing
+        Class method to write the searchable objects that are added, changed or deleted to the search outbox, in the same
+        transaction as the changes, so that no change is lost on its way to the search index. Objects whose searchable
+        fields are unchanged are left out.
         """
 
-        # save objects that are added, updated, or deleted into a dictionary attached to the session
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+        # there is no outbox to fill if full-text search is not configured
+        if not current_app.search_index:
+            return
+        rows = []
+        for obj in session.new | session.dirty | session.deleted:
+            if not isinstance(obj, SearchableMixin):
+                continue
+            if obj in session.dirty and not any(db.inspect(obj).attrs[field].history.has_changes()
+                                                for field in obj.__searchable__):
+                continue
+            rows.append({'index_name': obj.__tablename__, 'object_id': obj.id})
+        if rows:
+            session.connection().execute(SearchOutbox.__table__.insert(), rows)
+            session.info['search_outbox'] = True
 
     @classmethod
     def after_commit(cls, session):
-        """Class method to update the full-text search index based on changes made to the SQLAlchemy db."""
-
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        """Class method to schedule the draining of the search outbox after changes have been written to it."""
+
+        if session.info.pop('search_outbox', False):
+            SearchOutbox.schedule_drain()
 
     @classmethod
-    def reindex(cls):
-        """Class method to refresh a full-text search index with all the data from the relational db."""
+    def after_rollback(cls, session):
+        """Class method to forget about the search outbox rows of a transaction that has been rolled back."""
 
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        session.info.pop('search_outbox', None)
 
+    @classmethod
+    def reindex(cls, workers, batch_size, restart=False, progress=None):
+        """
+        Class method to rebuild the full-text search index of the model from the relational db. Rows are read in ranges
+        of batch_size ids, with the searchable columns only, and sent in bulk requests by a pool of worker threads. The
+        new index is built next to the one in use, and the index name is then made an alias of it, so that searches
+        keep working during the rebuild. The last id indexed is checkpointed after every range, and an interrupted
+        rebuild resumes from there unless restart is set. progress, if given, is called with the number of objects
+        indexed so far and the number to index after every range. It returns the number of objects indexed.
+        """
 
-# set up event handlers that make SQLAlchemy call SearchableMixin's before_commit() and after_commit()
-# before and after commits
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+        if not current_app.search_index:
+            return 0
+        index = cls.__tablename__
+        state = SearchReindex.query.get(index)
+        if state is not None and restart:
+            delete_index(state.target)
+            db.session.delete(state)
+            state = None
+        if state is None:
+            state = SearchReindex(index_name=index, target='{}-{}'.format(index, int(time())), last_id=0)
+            create_index(state.target)
+            db.session.add(state)
+            db.session.commit()
+
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        total = cls.query.filter(cls.id > state.last_id).count()
+        app = current_app._get_current_object()
+
+        def send(actions):
+            with app.app_context():
+                failed = bulk_index(actions)
+            if failed:
+                raise RuntimeError('{} objects could not be indexed'.format(len(failed)))
+            return len(actions)
+
+        # create only adds documents that are missing, so that the newer versions written by the search outbox in the
+        # meantime are kept
+        indexed = 0
+        last_id = state.last_id
+        pending = deque()
+        with ThreadPoolExecutor(workers) as executor:
+            while True:
+                rows = db.session.query(cls.id, *columns).filter(cls.id > last_id).order_by(cls.id).limit(
+                    batch_size).all()
+                if rows:
+                    last_id = rows[-1][0]
+                    pending.append((last_id, executor.submit(send, [
+                        ('create', state.target, row[0], dict(zip(cls.__searchable__, row[1:]))) for row in rows])))
+                # checkpoint the ranges that are done in order, and wait when enough requests are in flight
+                while pending and (not rows or len(pending) >= 2 * workers or pending[0][1].done()):
+                    range_end, future = pending.popleft()
+                    indexed += future.result()
+                    state.last_id = range_end
+                    db.session.commit()
+                    if progress is not None:
+                        progress(indexed, total)
+                if not rows:
+                    break
+
+        swap_alias(index, state.target)
+        bump_generations([index])
+        db.session.delete(state)
+        db.session.commit()
+        return indexed
+
+
+# set up event handlers that make SQLAlchemy write the changes to searchable objects to the search outbox, and drain it
+# after commits
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
+class SearchReindex(db.Model):
+    """
+    This class implements the data model for the rebuilds of full-text search indexes in progress, with the name of
+    the index being built and the last id indexed into it.
+    """
+
+    index_name = db.Column(db.String(64), primary_key=True)
+    target = db.Column(db.String(128))
+    last_id = db.Column(db.Integer, default=0)
+
+
+class SearchOutbox(db.Model):
+    """
+    This class implements the data model for the search outbox, which holds the searchable objects whose changes have
+    yet to be applied to the full-text search indexes. It is drained in bulk by a background job.
+    """
+
+    # set while a job to drain the outbox is waiting on the task queue, and while a retry is scheduled
+    SCHEDULED_KEY = 'search_outbox:scheduled'
+    RETRY_KEY = 'search_outbox:retry'
 
+    id = db.Column(db.Integer, primary_key=True)
+    index_name = db.Column(db.String(64))
+    object_id = db.Column(db.Integer)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.Float, index=True, default=0)
 
+    @classmethod
+    def drain(cls, session=None):
+        """
+        Class method to apply the changes waiting in the outbox to the search indexes, with one bulk request for every
+        SEARCH_OUTBOX_BATCH_SIZE rows. Objects are indexed as they are in the database at that time, or removed from
+        their index if they no longer exist, so that an object changed several times is sent once. Failed changes are
+        retried with exponential backoff. It returns the number of changes applied, and the number of seconds until
+        the next retry is due, or None if the outbox is empty.
+        """
+
+        session = session or db.session
+        r = get_redis()
+        if r is not None:
+            try:
+                # changes committed from now on need another drain
+                r.delete(cls.SCHEDULED_KEY)
+            except redis.exceptions.RedisError:
+                redis_failed()
+
+        searchable = {model.__tablename__: model for model in SearchableMixin.__subclasses__()}
+        batch_size = current_app.config['SEARCH_OUTBOX_BATCH_SIZE']
+        retry_seconds = current_app.config['SEARCH_OUTBOX_RETRY_SECONDS']
+        applied = 0
+        while True:
+            now = time()
+            rows = session.query(cls).filter(cls.next_attempt <= now).order_by(cls.id).limit(batch_size).all()
+            if not rows:
+                break
+            object_ids = defaultdict(set)
+            for row in rows:
+                object_ids[row.index_name].add(row.object_id)
+            actions = []
+            for index, ids in object_ids.items():
+                model = searchable[index]
+                objs = {obj.id: obj for obj in session.query(model).filter(model.id.in_(ids))}
+                actions += [('index', index, id, search_document(objs[id])) if id in objs else
+                            ('delete', index, id, None) for id in sorted(ids)]
+            changes = len(actions)
+            # while an index is being rebuilt, changes go to the new index as well as to the one in use
+            rebuilds = {rebuild.index_name: rebuild.target for rebuild in session.query(SearchReindex)}
+            actions += [(action, rebuilds[index], id, document) for action, index, id, document in actions
+                        if index in rebuilds]
+
+            try:
+                # changes are made visible to searches before the cached results are retired
+                failed = bulk_index(actions, refresh=True)
+            except BACKEND_ERRORS as e:
+                current_app.logger.warning('Search indexing failed, retrying later: {}'.format(e))
+                failed = {(index, id) for _, index, id, _ in actions}
+            origins = {target: index for index, target in rebuilds.items()}
+            failed = {(origins.get(index, index), id) for index, id in failed}
+            for row in rows:
+                if (row.index_name, row.object_id) in failed:
+                    row.attempts += 1
+                    row.next_attempt = now + min(retry_seconds * 2 ** (row.attempts - 1),
+                                                 current_app.config['SEARCH_OUTBOX_MAX_RETRY_SECONDS'])
+            session.query(cls).filter(cls.id.in_([row.id for row in rows if (row.index_name, row.object_id)
+                                                  not in failed])).delete(synchronize_session=False)
+            session.commit()
+            if len(failed) < changes:
+                bump_generations(list(object_ids))
+            applied += changes - len(failed)
+            if len(failed) == changes or len(rows) < batch_size:
+                break
+
+        next_attempt = session.query(db.func.min(cls.next_attempt)).scalar()
+        return applied, None if next_attempt is None else max(next_attempt - time(), retry_seconds)
+
+    @classmethod
+    def schedule_drain(cls, delay=0):
+        """
+        Class method to schedule a job that drains the outbox, in delay seconds, unless one is already scheduled. While
+        Redis is unreachable, the outbox is drained right away in this process instead, with a session of its own as
+        this is called once a transaction is committed.
+        """
+
+        r = get_redis()
+        if r is not None:
+            try:
+                if not delay:
+                    if r.set(cls.SCHEDULED_KEY, 1, nx=True, ex=60):
+                        current_app.task_queue.enqueue('app.tasks.drain_search_outbox')
+                elif r.set(cls.RETRY_KEY, 1, nx=True, ex=max(int(delay), 1)):
+                    current_app.task_queue.enqueue_in(timedelta(seconds=delay), 'app.tasks.drain_search_outbox')
+                return
+            except redis.exceptions.RedisError:
+                redis_failed()
+        if not delay:
+            with Session(db.engine) as session:
+                cls.drain(session)
+
+
+# The composite primary key doubles as the index for looking up who a user follows, and the reverse index serves
+# lookups of the followers of a user.
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 
@@ -103,8 +334,12 @@ class User(UserMixin, db.Model):
     are appropriate for most user model classes.
     """
 
+    # the columns left out of the snapshots cached by the user loader, as they change without the user editing anything
+    __uncached__ = ['last_seen', 'followers_count', 'followed_count', 'posts_count', 'unread_message_count',
+                    'pull_source']
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(64), index=True, unique=True)
+    # the previous username is loaded when it is changed, for the handlers that act on renames to know it
+    username = db.column_property(db.Column(db.String(64), index=True, unique=True), active_history=True)
     email = db.Column(db.String(128), index=True, unique=True)
     password_hash = db.Column(db.String(128))
     # The User class has a new posts field, that is initialized with db.relationship. This is not an actual database field, 
@@ -136,6 +371,17 @@ class User(UserMixin, db.Model):
         foreign_keys='Message.recipient_id', backref='recipient', 
         lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    # denormalized counters, kept up to date by follow(), unfollow() and post creation/deletion, so that profiles can
+    # be rendered without counting rows
+    followers_count = db.Column(db.Integer, index=True, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # the number of messages received since last_message_read_time, kept up to date by message creation and reset by
+    # reading the messages
+    unread_message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # whether the posts of the user are pulled into the home timelines of their followers at read time instead of
+    # pushed to them, kept up to date by follow() and unfollow() (see update_pull_source())
+    pull_source = db.Column(db.Boolean, index=True, nullable=False, default=False, server_default=db.false())
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
 
@@ -158,21 +404,190 @@ class User(UserMixin, db.Model):
         return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
 
     def follow(self, user):
-        """This method adds a user to the list of followed's of the self user, if not already followed."""
+        """
+        This method adds a user to the list of followed's of the self user, if not already followed. The check reads the
+        followers table, as the follow graph cache of this worker may not have seen a follow committed by another one.
+        """
 
-        if not self.is_following(user):
+        if not self.is_following(user, cached=False):
             self.followed.append(user)
+            User.increment_counter(self.id, 'followed_count', 1)
+            User.increment_counter(user.id, 'followers_count', 1)
+            User.update_pull_source(user.id)
+            db.session.info.setdefault('timeline_jobs', []).append(('backfill_timeline', self.id, user.id))
+            touch(db.session, 'profile:{}'.format(user.username))
 
     def unfollow(self, user):
-        """This method removes a user from the list of followe's of the self user, if still followed."""
+        """This method removes a user from the list of followe's of the self user, if still followed in the database."""
 
-        if self.is_following(user):
+        if self.is_following(user, cached=False):
             self.followed.remove(user)
+            User.increment_counter(self.id, 'followed_count', -1)
+            User.increment_counter(user.id, 'followers_count', -1)
+            User.update_pull_source(user.id)
+            db.session.info.setdefault('timeline_jobs', []).append(('purge_timeline', self.id, user.id))
+            touch(db.session, 'profile:{}'.format(user.username))
 
-    def is_following(self, user):
-        """This method checks if a user is being followed by the self user."""
+    @classmethod
+    def increment_counter(cls, user_id, counter, delta, session=None):
+        """
+        Class method to atomically add delta to one of the denormalized counters of a user, with an UPDATE statement
+        relative to the value in the database. The counter is expired on the loaded user, if any, to be read again.
+        """
 
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        session = session or db.session
+        session.connection().execute(cls.__table__.update().where(cls.id == user_id).values(
+            {counter: getattr(cls, counter) + delta}))
+        user = session.identity_map.get(identity_key(cls, user_id))
+        if user is not None:
+            session.expire(user, [counter])
+
+    @classmethod
+    def update_pull_source(cls, user_id, session=None):
+        """
+        Class method to turn a user into a pull source once it has FEED_PULL_THRESHOLD followers, and back into a
+        regular account once it has fewer than FEED_PULL_DEMOTE_THRESHOLD. The gap between the two keeps accounts from
+        flipping back and forth around a single threshold. The posts that a demoted user wrote as a pull source were
+        never pushed, so they are pushed to its followers once the change is committed.
+        """
+
+        session = session or db.session
+        connection = session.connection()
+        promoted = connection.execute(cls.__table__.update().where(cls.id == user_id).where(
+            cls.pull_source == db.false()).where(
+            cls.followers_count >= current_app.config['FEED_PULL_THRESHOLD']).values(pull_source=True)).rowcount
+        demoted = connection.execute(cls.__table__.update().where(cls.id == user_id).where(
+            cls.pull_source == db.true()).where(
+            cls.followers_count < current_app.config['FEED_PULL_DEMOTE_THRESHOLD']).values(pull_source=False)).rowcount
+        if promoted or demoted:
+            session.info['pull_sources_changed'] = True
+            user = session.identity_map.get(identity_key(cls, user_id))
+            if user is not None:
+                session.expire(user, ['pull_source'])
+        if demoted:
+            session.info.setdefault('pull_sources_demoted', []).append(user_id)
+
+    @classmethod
+    def push_recent_posts(cls, user_id, session=None):
+        """
+        Class method to push the recent posts of a user into the home timelines of its followers, after the user has
+        stopped being a pull source.
+        """
+
+        session = session or db.session
+        rows = session.query(Post.id, Post.timestamp).filter(Post.user_id == user_id).order_by(
+            Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'] + 1)
+        entries = [(post_id, timestamp_score(timestamp)) for post_id, timestamp in rows]
+        if entries:
+            for follower_id in Post._follower_ids(session, user_id):
+                backfill_timeline(follower_id, entries)
+
+    @classmethod
+    def reconcile_counters(cls):
+        """
+        Class method to recompute the denormalized counters of all users from the followers, post and message tables
+        in one bulk UPDATE, in case they have drifted. It returns the number of users whose counters were fixed.
+        """
+
+        followers_count = db.select([db.func.count()]).where(followers.c.followed_id == cls.id).scalar_subquery()
+        followed_count = db.select([db.func.count()]).where(followers.c.follower_id == cls.id).scalar_subquery()
+        posts_count = db.select([db.func.count()]).where(Post.user_id == cls.id).scalar_subquery()
+        # served by the index on the recipient and timestamp of messages
+        unread_message_count = db.select([db.func.count()]).where(
+            Message.recipient_id == cls.id).where(
+            Message.timestamp > db.func.coalesce(cls.last_message_read_time, datetime(1900, 1, 1))).scalar_subquery()
+        result = db.session.execute(cls.__table__.update().where(db.or_(
+            cls.followers_count != followers_count, cls.followed_count != followed_count,
+            cls.posts_count != posts_count, cls.unread_message_count != unread_message_count)).values(
+            followers_count=followers_count, followed_count=followed_count, posts_count=posts_count,
+            unread_message_count=unread_message_count))
+        db.session.expire_all()
+        return result.rowcount
+
+    def followed_ids(self):
+        """This method returns the set of ids of the users followed by self, from the follow graph cache."""
+
+        return get_followed_ids(self.id, lambda: [followed_id for followed_id, in db.session.query(
+            followers.c.followed_id).filter(followers.c.follower_id == self.id)])
+
+    def is_following(self, user, cached=True):
+        """
+        This method checks if a user is being followed by the self user. The check is answered by the follow graph 
+        cache, unless cached is False, the follows of self have changed in the current transaction, or either user has 
+        not been flushed to the database yet.
+        """
+
+        if not cached or self.id is None or user.id is None or \
+                self in db.session.info.get('follow_graph_dirty', ()):
+            return self.followed.filter(followers.c.followed_id == user.id).first() is not None
+        return user.id in self.followed_ids()
+
+    def is_following_many(self, user_ids):
+        """This method checks which of the given user ids are followed by self, and returns a {user_id: bool} dict."""
+
+        if self in db.session.info.get('follow_graph_dirty', ()):
+            followed_ids = {followed_id for followed_id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids))}
+        else:
+            followed_ids = self.followed_ids()
+        return {user_id: user_id in followed_ids for user_id in user_ids}
+
+    @staticmethod
+    def follow_graph_changed(target, value, initiator):
+        """
+        Static method called when a user is appended to or removed from the followed collection of another user, 
+        directly or through the followers backref. It flags the follower as changed in the current transaction, so 
+        that its cached follow graph is bypassed until commit.
+        """
+
+        db.session.info.setdefault('follow_graph_dirty', set()).add(target)
+
+    @staticmethod
+    def follow_graph_after_flush(session, flush_context):
+        """Static method to collect the ids of the users whose follows were flushed, while the ids can be read."""
+
+        for user in session.info.get('follow_graph_dirty', ()):
+            if user.id is not None:
+                session.info.setdefault('follow_graph_flushed', set()).add(user.id)
+
+    @staticmethod
+    def follow_graph_after_commit(session):
+        """Static method to invalidate the cached follow graphs of the users whose follows were committed."""
+
+        session.info.pop('follow_graph_dirty', None)
+        invalidate_followed_ids(list(session.info.pop('follow_graph_flushed', ())))
+
+    @staticmethod
+    def follow_graph_after_rollback(session):
+        """Static method to discard the follow graph changes of a transaction that has been rolled back."""
+
+        session.info.pop('follow_graph_dirty', None)
+        session.info.pop('follow_graph_flushed', None)
+
+    @staticmethod
+    def user_cache_after_flush(session, flush_context):
+        """
+        Static method to collect the ids of the users whose cached columns were flushed, that is the columns that the
+        user loader keeps snapshots of.
+        """
+
+        for obj in session.dirty | session.deleted:
+            if isinstance(obj, User) and (obj in session.deleted or any(
+                    db.inspect(obj).attrs[column.key].history.has_changes() for column in User.__table__.columns
+                    if column.key not in User.__uncached__)):
+                session.info.setdefault('user_cache_flushed', set()).add(obj.id)
+
+    @staticmethod
+    def user_cache_after_commit(session):
+        """Static method to invalidate the cached snapshots of the users whose changes were committed."""
+
+        invalidate_users(list(session.info.pop('user_cache_flushed', ())))
+
+    @staticmethod
+    def user_cache_after_rollback(session):
+        """Static method to discard the user changes of a transaction that has been rolled back."""
+
+        session.info.pop('user_cache_flushed', None)
 
     def followed_posts(self):
         """This method queries all posts of self and self's followed users and order them by descending timestamps."""
@@ -182,6 +597,87 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline(self, per_page, after=None, before=None, page=None):
+        """
+        This method returns a KeysetPage of posts from the home timeline of self, right after or right before a
+        (timestamp, id) cursor. The feed is assembled from two kinds of sources: the posts of regular accounts are
+        pushed into the precomputed timeline of self when they are committed, while the posts of high-follower accounts
+        (see pull_source_ids()) are pulled from their authors at read time. The sources are combined with a heap-based
+        k-way merge. Page numbers from old links are served by followed_posts() directly.
+        """
+
+        if page is not None and after is None and before is None:
+            return keyset_paginate(self.followed_posts(), Post, per_page, page=page)
+
+        sources = [self.pushed_posts(per_page + 1, after, before)]
+        for user_id in (self.followed_ids() & pull_source_ids()) - {self.id}:
+            pulled = keyset_query(Post.query.filter_by(user_id=user_id), Post, after=after, before=before)
+            pulled = pulled.limit(per_page + 1).all()
+            sources.append(pulled[::-1] if before is not None else pulled)
+
+        # every source is ordered from newest to oldest, and posts pushed before their author became a pull source
+        # can show up twice
+        posts, seen = [], set()
+        for post in heapq.merge(*sources, key=lambda post: (post.timestamp, post.id), reverse=True):
+            if post.id not in seen:
+                seen.add(post.id)
+                posts.append(post)
+        if before is not None:
+            posts = posts[-(per_page + 1):]
+            return KeysetPage(posts[-per_page:], has_next=True, has_prev=len(posts) > per_page)
+        return KeysetPage(posts[:per_page], has_next=len(posts) > per_page, has_prev=after is not None)
+
+    def pushed_posts(self, count, after=None, before=None):
+        """
+        This method returns up to count posts, newest first, from the precomputed home timeline of self, right after or
+        right before a (timestamp, id) cursor. Post ids are read from the timeline cache and hydrated with a single
+        query. The cache is built from followed_posts() on first use, and posts older than the cached entries are read
+        from followed_posts().
+        """
+
+        cursors = {name: (timestamp_score(cursor[0]), cursor[1])
+                   for name, cursor in (('after', after), ('before', before)) if cursor is not None}
+        cached = get_timeline(self.id, count, **cursors)
+        if cached is None:
+            self.rebuild_timeline()
+            cached = get_timeline(self.id, count, **cursors)
+        ids, covered = cached
+        if before is not None and not covered:
+            return keyset_query(self.followed_posts(), Post, before=before).limit(count).all()[::-1]
+        posts = {post.id: post for post in Post.query.filter(Post.id.in_(ids))}
+        posts = [posts[post_id] for post_id in ids if post_id in posts]
+
+        # continue past the end of an incomplete timeline with the database
+        if before is None and len(posts) < count and not covered:
+            last = (posts[-1].timestamp, posts[-1].id) if posts else after
+            posts += keyset_query(self.followed_posts(), Post, after=last).limit(count - len(posts)).all()
+        return posts
+
+    def rebuild_timeline(self):
+        """This method materializes the home timeline of self from the most recent followed posts."""
+
+        length = current_app.config['TIMELINE_LENGTH']
+        rows = self.followed_posts().with_entities(Post.id, Post.timestamp).limit(length + 1).all()
+        set_timeline(self.id, [(post_id, timestamp_score(timestamp)) for post_id, timestamp in rows[:length]],
+                     complete=len(rows) <= length)
+
+    def backfill_timeline(self, user):
+        """This method merges the recent posts of a newly followed user into the home timeline of self."""
+
+        # the posts of pull sources are merged into the feed at read time
+        if user.id in pull_source_ids():
+            return
+        rows = user.posts.with_entities(Post.id, Post.timestamp).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_LENGTH'] + 1)
+        backfill_timeline(self.id, [(post_id, timestamp_score(timestamp)) for post_id, timestamp in rows])
+
+    def purge_timeline(self, user):
+        """This method removes the posts of an unfollowed user from the home timeline of self."""
+
+        rows = user.posts.with_entities(Post.id).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_LENGTH'] + 1)
+        remove_from_timelines([self.id], [post_id for post_id, in rows])
+
     def get_reset_password_token(self, expires_in=600):
         """This method gets a JWT token for password resets."""
 
@@ -199,19 +695,35 @@ class User(UserMixin, db.Model):
             return User.query.get(id)
 
     def new_messages(self):
-        """This method returns the number of unread messages."""
+        """This method returns the number of unread messages, from the denormalized counter."""
 
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return self.unread_message_count
 
     def add_notification(self, name, data):
-        """This method adds new notifications to the Notification database."""
+        """
+        This method sets the notification of the given name of self, updating the existing one in place if there is
+        one, with a single upsert statement. Like new notifications, it is published once committed.
+        """
 
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        values = {'user_id': self.id, 'name': name, 'payload_json': json.dumps(data), 'timestamp': time()}
+        dialect = db.engine.dialect.name
+        if dialect == 'mysql':
+            statement = mysql_insert(Notification.__table__).values(**values)
+            statement = statement.on_duplicate_key_update(payload_json=statement.inserted.payload_json,
+                                                          timestamp=statement.inserted.timestamp)
+        else:
+            insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+            statement = insert(Notification.__table__).values(**values)
+            statement = statement.on_conflict_do_update(index_elements=['user_id', 'name'], set_={
+                'payload_json': statement.excluded.payload_json, 'timestamp': statement.excluded.timestamp})
+        db.session.execute(statement)
+
+        # the upsert bypasses the unit of work, so the notification is queued for publishing and its version stamps
+        # are touched here, the latter including the user's stamp as notifications carry the progress of the tasks
+        # shown on every page
+        db.session.info.setdefault('notifications_published', []).append((self.id, json.dumps(
+            {'name': name, 'data': data, 'timestamp': values['timestamp']})))
+        touch(db.session, 'notifications:{}'.format(self.id), 'user:{}'.format(self.id))
 
     def launch_task(self, name, description, *args, **kwargs):
         """
@@ -238,10 +750,71 @@ class User(UserMixin, db.Model):
             user=self, complete=False, name=name).first()
 
 
+# set up event handlers that keep the follow graph cache consistent with the followers table
+db.event.listen(User.followed, 'append', User.follow_graph_changed)
+db.event.listen(User.followed, 'remove', User.follow_graph_changed)
+db.event.listen(db.session, 'after_flush', User.follow_graph_after_flush)
+db.event.listen(db.session, 'after_commit', User.follow_graph_after_commit)
+db.event.listen(db.session, 'after_rollback', User.follow_graph_after_rollback)
+
+# set up event handlers that keep the user snapshots cached for the user loader consistent with the user table
+db.event.listen(db.session, 'after_flush', User.user_cache_after_flush)
+db.event.listen(db.session, 'after_commit', User.user_cache_after_commit)
+db.event.listen(db.session, 'after_rollback', User.user_cache_after_rollback)
+
+
+def pull_source_ids():
+    """
+    This function returns the set of ids of the users who are pull sources, that is who have reached
+    FEED_PULL_THRESHOLD followers (see User.update_pull_source()). Their posts are not pushed to the home timelines of
+    their followers, which would take one write per follower, but pulled when the timelines are read. The set is cached
+    in each worker for FEED_PULL_SOURCES_TTL seconds.
+    """
+
+    cache = local_store('pull_sources', lambda: LRUCache(1, current_app.config['FEED_PULL_SOURCES_TTL']))
+    ids = cache.get('ids')
+    if ids is None:
+        ids = frozenset(user_id for user_id, in db.session.query(User.id).filter(User.pull_source == db.true()))
+        cache.set('ids', ids)
+    return ids
+
+
 @login.user_loader
 def load_user(id):
-    """This function implements a user loader, required by Flask-Login, and returns the user object given a user id."""
-    return User.query.get(int(id))
+    """
+    This function implements a user loader, required by Flask-Login, and returns the user object given a user id. The
+    user is rebuilt from a snapshot cached in the worker when possible, so that requests which only need the identity
+    of the user do not query the database.
+    """
+
+    return load_cached_user(User, int(id))
+
+
+def load_authors(items):
+    """
+    This function loads the authors of a list of posts or messages with a single query, and attaches them to the 
+    items, so that rendering the items does not lazy-load their authors one at a time. 
+
+    The database session lives for one request, so its identity map acts as a per-request cache of users: authors 
+    already loaded in the request, such as the user loaded by Flask-Login, are taken from it instead of being queried.
+    """
+
+    if not items:
+        return items
+    author = db.inspect(type(items[0])).relationships['author']
+    foreign_key = next(iter(author.local_columns)).key
+    authors = {}
+    for item in items:
+        user_id = getattr(item, foreign_key)
+        if user_id not in authors:
+            authors[user_id] = db.session.identity_map.get(identity_key(User, user_id))
+    # expired users, such as the ones expired by a commit earlier in the request, are refreshed in the same query
+    missing = [user_id for user_id, user in authors.items() if user is None or db.inspect(user).expired]
+    if missing:
+        authors.update((user.id, user) for user in User.query.filter(User.id.in_(missing)))
+    for item in items:
+        set_committed_value(item, 'author', authors.get(getattr(item, foreign_key)))
+    return items
 
 
 class Post(SearchableMixin, db.Model):
@@ -249,6 +822,8 @@ class Post(SearchableMixin, db.Model):
 
     # an attribute for the full-text search abstraction
     __searchable__ = ['body']
+    # an index to list the posts of a user by timestamp
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -264,6 +839,152 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post: {}>'.format(self.body)
 
+    @classmethod
+    def explore(cls, per_page, after=None, before=None, page=None):
+        """
+        Class method to return a KeysetPage of the posts of all users, right after or right before a (timestamp, id)
+        cursor. Pages within the global timeline are read from it, so that the post table only gets a lookup by
+        primary key. Deeper pages, and page numbers from old links, are read from the post table.
+        """
+
+        cursors = {name: (timestamp_score(cursor[0]), cursor[1])
+                   for name, cursor in (('after', after), ('before', before)) if cursor is not None}
+        cached = None
+        if page is None or cursors:
+            cached = get_timeline(GLOBAL, per_page + 1, **cursors)
+            if cached is None:
+                cls.rebuild_explore()
+                cached = get_timeline(GLOBAL, per_page + 1, **cursors)
+        if cached is None or not (cached[1] or (before is None and len(cached[0]) > per_page)):
+            return keyset_paginate(cls.query, cls, per_page, after=after, before=before, page=page)
+
+        ids = cached[0]
+        posts = {post.id: post for post in cls.query.filter(cls.id.in_(ids))}
+        posts = [posts[post_id] for post_id in ids if post_id in posts]
+        if before is not None:
+            return KeysetPage(posts[-per_page:], has_next=True, has_prev=len(posts) > per_page)
+        return KeysetPage(posts[:per_page], has_next=len(posts) > per_page, has_prev=after is not None)
+
+    @classmethod
+    def rebuild_explore(cls):
+        """Class method to materialize the global timeline from the most recent posts."""
+
+        length = current_app.config['EXPLORE_TIMELINE_LENGTH']
+        rows = keyset_query(cls.query, cls).with_entities(cls.id, cls.timestamp).limit(length + 1).all()
+        set_timeline(GLOBAL, [(post_id, timestamp_score(timestamp)) for post_id, timestamp in rows[:length]],
+                     complete=len(rows) <= length)
+
+    @classmethod
+    def _follower_ids(cls, session, user_id):
+        """Class method to look up the ids of the followers of a user on the connection of an ongoing flush."""
+
+        return [row[0] for row in session.connection().execute(
+            db.select([followers.c.follower_id]).where(followers.c.followed_id == user_id))]
+
+    @classmethod
+    def _timeline_user_ids(cls, session, user_id):
+        """
+        Class method to look up the users whose home timelines a new post by the given author is pushed to by
+        fan_out(): the followers of the author, unless the author has so many followers that it is a pull source.
+        """
+
+        if session.connection().execute(db.select([User.pull_source]).where(User.id == user_id)).scalar():
+            return []
+        return cls._follower_ids(session, user_id)
+
+    @classmethod
+    def fan_out(cls, post_id, user_id, score, session=None):
+        """
+        Class method to push a committed post into the home timelines of the followers of its author. It runs in a
+        background job, so that creating a post does not take one write per follower.
+        """
+
+        session = session or db.session
+        if session.get(cls, post_id) is None:
+            return
+        add_to_timelines(cls._timeline_user_ids(session, user_id), post_id, score)
+
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        """
+        Class method to record which home timelines the posts about to be deleted need to be removed from, while
+        the posts can still be loaded, and to decrement the post counters of their authors.
+        """
+
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                session.info.setdefault('timeline_delete', []).append(
+                    (obj.id, [obj.user_id] + cls._follower_ids(session, obj.user_id)))
+                User.increment_counter(obj.user_id, 'posts_count', -1, session=session)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Class method to record the newly flushed posts, to be pushed to the home timelines after a successful commit.
+        The post counters of the authors are incremented as well.
+        """
+
+        for obj in session.new:
+            if isinstance(obj, Post):
+                session.info.setdefault('timeline_add', []).append(
+                    (obj.id, timestamp_score(obj.timestamp), obj.user_id))
+                User.increment_counter(obj.user_id, 'posts_count', 1, session=session)
+
+    @classmethod
+    def after_commit(cls, session):
+        """
+        Class method to push committed posts to the home timelines of their authors and to the global timeline, and to
+        hand the fan-out to the followers, follow changes and the demotion of pull sources to jobs on the task queue.
+        Without a task queue, the fan-out and the demotions are done right away, with sessions of their own as the
+        transaction is over.
+        """
+
+        for post_id, score, user_id in session.info.pop('timeline_add', []):
+            add_to_timelines([user_id], post_id, score)
+            add_to_timelines([GLOBAL], post_id, score, max_length=current_app.config['EXPLORE_TIMELINE_LENGTH'])
+            if get_redis() is not None:
+                try:
+                    current_app.task_queue.enqueue('app.tasks.fan_out_post', post_id, user_id, score)
+                    continue
+                except redis.exceptions.RedisError:
+                    redis_failed()
+            with Session(db.engine) as fan_out_session:
+                cls.fan_out(post_id, user_id, score, fan_out_session)
+        if session.info.pop('pull_sources_changed', False):
+            current_app.local_stores.pop('pull_sources', None)
+        for user_id in session.info.pop('pull_sources_demoted', []):
+            if get_redis() is not None:
+                try:
+                    current_app.task_queue.enqueue('app.tasks.push_recent_posts', user_id)
+                    continue
+                except redis.exceptions.RedisError:
+                    redis_failed()
+            with Session(db.engine) as push_session:
+                User.push_recent_posts(user_id, push_session)
+        for post_id, user_ids in session.info.pop('timeline_delete', []):
+            remove_from_timelines(user_ids + [GLOBAL], [post_id])
+        for name, user_id, followed_id in session.info.pop('timeline_jobs', []):
+            try:
+                current_app.task_queue.enqueue('app.tasks.' + name, user_id, followed_id)
+            except redis.exceptions.RedisError:
+                # without a task queue, drop the timeline so that it gets rebuilt from the database on the next read
+                clear_timeline(user_id)
+
+    @classmethod
+    def after_rollback(cls, session):
+        """Class method to discard the timeline changes recorded for a transaction that has been rolled back."""
+
+        for key in ('timeline_add', 'timeline_delete', 'timeline_jobs', 'pull_sources_changed',
+                    'pull_sources_demoted'):
+            session.info.pop(key, None)
+
+
+# set up event handlers that keep the precomputed home timelines in sync with committed posts and follows
+db.event.listen(db.session, 'before_flush', Post.before_flush)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_rollback', Post.after_rollback)
+
 
 class Message(db.Model):
     """
@@ -271,6 +992,10 @@ class Message(db.Model):
     class of db.Model.
     """
 
+    # an index to list the messages received by a user by timestamp
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp', 
+                               'recipient_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -280,6 +1005,18 @@ class Message(db.Model):
     def __repr__(self):
         return '<Message: {}>'.format(self.body)
 
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """Class method to count the newly flushed messages in the unread message counters of their recipients."""
+
+        for obj in session.new:
+            if isinstance(obj, Message):
+                User.increment_counter(obj.recipient_id, 'unread_message_count', 1, session=session)
+
+
+# set up an event handler that keeps the unread message counters up to date
+db.event.listen(db.session, 'after_flush', Message.after_flush)
+
 
 class Notification(db.Model):
     """
@@ -287,10 +1024,15 @@ class Notification(db.Model):
     from the parent model of db.Model.
     """
 
+    # each user has at most one notification of each name, which is updated in place, the first index serves the
+    # queries of the notifications of a user since a given time, and the second one the purge of expired notifications
+    __table_args__ = (db.UniqueConstraint('user_id', 'name', name='uq_notification_user_id_name'),
+                      db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+                      db.Index('ix_notification_timestamp', 'timestamp'))
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(128), index=True)
+    name = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    timestamp = db.Column(db.Float, index=True, default=time)
+    timestamp = db.Column(db.Float, default=time)
     payload_json = db.Column(db.Text)
 
     def get_data(self):
@@ -298,6 +1040,49 @@ class Notification(db.Model):
 
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        """This method returns the notification as sent to the browser."""
+
+        return {'name': self.name, 'data': self.get_data(), 'timestamp': self.timestamp}
+
+    @classmethod
+    def after_commit(cls, session):
+        """
+        Class method to publish the notifications set by User.add_notification() to the notification streams of their
+        users, once committed. Browsers that miss them, while Redis is unreachable, still get them by polling.
+        """
+
+        for user_id, message in session.info.pop('notifications_published', []):
+            try:
+                current_app.broker.publish(user_id, message)
+            except redis.exceptions.RedisError:
+                redis_failed()
+                break
+
+    @classmethod
+    def after_rollback(cls, session):
+        """Class method to discard the notifications of a transaction that has been rolled back."""
+
+        session.info.pop('notifications_published', None)
+
+    @classmethod
+    def purge_expired(cls, before, batch_size):
+        """
+        Class method to delete the notifications last updated before the given time, in batches of batch_size rows. It
+        returns the number of notifications deleted.
+        """
+
+        deleted = 0
+        for rows in delete_in_batches(cls, cls.timestamp < before, batch_size, cls.user_id):
+            touch(db.session, *{'notifications:{}'.format(user_id) for _, user_id in rows})
+            deleted += len(rows)
+        return deleted
+
+
+# set up event handlers that publish notifications to the notification streams once they are committed
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
+
 
 class Task(db.Model):
     """
@@ -305,11 +1090,14 @@ class Task(db.Model):
     model of db.Model.
     """
 
+    # serves the queries of the tasks in progress of a user
+    __table_args__ = (db.Index('ix_task_user_id_complete', 'user_id', 'complete'),)
     id = db.Column(db.String(36), primary_key=True)
     name = db.Column(db.String(128), index=True)
     description = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     complete = db.Column(db.Boolean, default=False)
+    completed_at = db.Column(db.Float, index=True)
 
     def get_rq_job(self):
         """This method returns the RQ job object of the current task."""
@@ -325,3 +1113,42 @@ class Task(db.Model):
 
         job = self.get_rq_job()
         return job.meta.get('progress', 0) if job is not None else 100
+
+    @classmethod
+    def purge_completed(cls, before, batch_size):
+        """
+        Class method to delete the tasks completed before the given time, in batches of batch_size rows. It returns the
+        number of tasks deleted.
+        """
+
+        deleted = 0
+        for rows in delete_in_batches(cls, cls.completed_at < before, batch_size):
+            deleted += len(rows)
+        return deleted
+
+
+def touch_stamps(session, flush_context):
+    """
+    This function records the version stamps (see app/etags.py) of the pages that show the objects being flushed, to
+    be bumped once the transaction is committed.
+    """
+
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Post) and obj not in session.dirty:
+            touch(session, 'posts')
+        elif isinstance(obj, User):
+            # both the current and any previous username of the user
+            history = db.inspect(obj).attrs.username.history
+            touch(session, 'user:{}'.format(obj.id),
+                  *['profile:{}'.format(username) for username in history.sum() if username])
+            # the feeds show the username and avatar of the authors of their posts
+            if obj in session.dirty and (history.has_changes() or db.inspect(obj).attrs.email.history.has_changes()):
+                touch(session, 'posts')
+        elif isinstance(obj, Message) and obj in session.new:
+            touch(session, 'user:{}'.format(obj.recipient_id))
+        elif isinstance(obj, Task):
+            touch(session, 'user:{}'.format(obj.user_id))
+
+
+# set up an event handler that keeps the version stamps behind the ETags of pages in sync with committed changes
+db.event.listen(db.session, 'after_flush', touch_stamps)
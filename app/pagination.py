@@ -0,0 +1,140 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import request
+from app import db
+
+
+def encode_cursor(timestamp, id):
+    """This function encodes the (timestamp, id) position of a row into an opaque, URL-safe cursor token."""
+
+    token = '{}|{}'.format(timestamp.isoformat(), id).encode('utf-8')
+    return urlsafe_b64encode(token).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """This function decodes a cursor token back into a (timestamp, id) tuple, or returns None if it is not valid."""
+
+    if not token:
+        return None
+    try:
+        timestamp, id = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8').split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        return None
+
+
+def encode_search_cursor(sort_values):
+    """This function encodes the sort values of a search hit into an opaque, URL-safe cursor token."""
+
+    token = json.dumps(sort_values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(token).decode('ascii').rstrip('=')
+
+
+def decode_search_cursor(token):
+    """This function decodes a cursor token back into the sort values of a search hit, or returns None if it is invalid."""
+
+    if not token:
+        return None
+    try:
+        sort_values = json.loads(urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(sort_values, list) or len(sort_values) != 2 or \
+            not all(isinstance(value, (int, float, str)) for value in sort_values):
+        return None
+    return sort_values
+
+
+def get_page_args():
+    """
+    This function reads the pagination arguments of the current request: an 'after' cursor for older rows, a 'before'
+    cursor for newer rows, or a page number, which keeps links from before cursors were introduced working.
+    """
+
+    return {'after': decode_cursor(request.args.get('after')),
+            'before': decode_cursor(request.args.get('before')),
+            'page': request.args.get('page', type=int)}
+
+
+class KeysetPage(object):
+    """
+    This class holds one page of rows ordered by descending (timestamp, id), along with the cursors to the pages
+    around it. It stands in for the Pagination objects returned by paginate(), without the COUNT query behind them.
+    """
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+
+    @property
+    def next_cursor(self):
+        """The cursor of the page of older rows."""
+
+        return encode_cursor(self.items[-1].timestamp, self.items[-1].id) if self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        """The cursor of the page of newer rows."""
+
+        return encode_cursor(self.items[0].timestamp, self.items[0].id) if self.has_prev else None
+
+
+class SearchPage(object):
+    """
+    This class holds one page of search hits, in descending order of relevance, along with the total number of hits
+    and the cursors to the pages around it, which are the sort values of its first and last hits.
+    """
+
+    def __init__(self, hits, total, has_next, has_prev):
+        self.items = [obj for obj, _ in hits]
+        self.sort_values = [sort_values for _, sort_values in hits]
+        self.total = total
+        self.has_next = has_next and bool(hits)
+        self.has_prev = has_prev and bool(hits)
+
+    @property
+    def next_cursor(self):
+        """The cursor of the page of less relevant hits."""
+
+        return encode_search_cursor(self.sort_values[-1]) if self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        """The cursor of the page of more relevant hits."""
+
+        return encode_search_cursor(self.sort_values[0]) if self.has_prev else None
+
+
+def keyset_query(query, model, after=None, before=None):
+    """
+    This function narrows a query down to the rows right after (older than) or right before (newer than) a
+    (timestamp, id) cursor, seeking on the pair instead of scanning with OFFSET. Rows come out in descending order,
+    or in ascending order when reading before a cursor.
+    """
+
+    key = db.tuple_(model.timestamp, model.id)
+    query = query.order_by(None)
+    if before is not None:
+        return query.filter(key > before).order_by(model.timestamp.asc(), model.id.asc())
+    if after is not None:
+        query = query.filter(key < after)
+    return query.order_by(model.timestamp.desc(), model.id.desc())
+
+
+def keyset_paginate(query, model, per_page, after=None, before=None, page=None):
+    """
+    This function returns a KeysetPage of the given query. One extra row is fetched to tell if there is a next page,
+    so no COUNT query is needed. Page numbers are still served with OFFSET, for old links.
+    """
+
+    if before is not None:
+        rows = keyset_query(query, model, before=before).limit(per_page + 1).all()
+        return KeysetPage(rows[:per_page][::-1], has_next=True, has_prev=len(rows) > per_page)
+    if after is not None:
+        rows = keyset_query(query, model, after=after).limit(per_page + 1).all()
+        return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_prev=True)
+    page = page if page and page > 0 else 1
+    rows = keyset_query(query, model).offset((page - 1) * per_page).limit(per_page + 1).all()
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_prev=page > 1)
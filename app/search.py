@@ -1,37 +1,484 @@
+import os
+import re
+import json
+import sqlite3
+from collections import defaultdict
+from hashlib import md5
+from threading import Lock, RLock
 from flask import current_app
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError
+from sqlalchemy.engine.url import make_url
+from redis.exceptions import RedisError
+from app.cache import get_redis, redis_failed, local_store, LRUCache
 
 
-def add_to_index(index, model):
-    """This function adds a given index along with a specified data model/table to the app's elasticsearch instance."""
+# The search backend of the app, app.search_index, is an Elasticsearch client, or an object that implements the same
+# subset of its API: bulk(body), search(index, body) with a multi_match query, and indices.create(), delete(),
+# exists(), exists_alias(), get_alias() and update_aliases(). The backends are:
+#   elasticsearch   an Elasticsearch cluster, at ELASTICSEARCH_URL
+#   fts             FTSIndex, SQLite FTS5 tables in the app database if it is SQLite, or else in the database file at
+#                   SEARCH_FTS_DATABASE, which must be on storage shared by the web and task workers
+#   memory          MemoryIndex, in-process dictionaries, for the tests
+#   none            no full-text search
 
-    # return None if elasticsearch is not configured
-    if not current_app.elasticsearch:
-        return
-    
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+# the errors that backends raise when they cannot be reached, after which changes are retried later
+BACKEND_ERRORS = (TransportError, sqlite3.Error)
 
 
-def remove_from_index(index, model):
-    """This function removes a given index from the app's elasticsearch instance."""
+def make_search_index(config):
+    """
+    This function returns the search backend selected by SEARCH_BACKEND in the given configuration, which defaults to
+    Elasticsearch if ELASTICSEARCH_URL is set, and to SQLite FTS5 otherwise.
+    """
 
-    # return None if elasticsearch is not configured
-    if not current_app.elasticsearch:
-        return 
+    backend = config['SEARCH_BACKEND'] or ('elasticsearch' if config['ELASTICSEARCH_URL'] else 'fts')
+    if backend == 'elasticsearch':
+        return Elasticsearch(config['ELASTICSEARCH_URL'])
+    if backend == 'fts':
+        return FTSIndex(fts_database(config), wal=bool(config['SEARCH_FTS_DATABASE']))
+    if backend == 'memory':
+        return MemoryIndex()
+    return None
 
-    current_app.elasticsearch.delete(index=index, id=model.id)
 
+def fts_database(config):
+    """
+    This function returns the path of the SQLite database that holds the FTS5 tables: SEARCH_FTS_DATABASE if set, or
+    else the app database if it is a SQLite file, which every process of the app shares already. The search outbox is
+    drained by the task workers, so a database file of each host would leave searches on the other hosts empty, which
+    is why the app refuses to start without a database that all processes share.
+    """
 
-def query_index(index, query, page, per_page):
-    """This function queries a given index and a given query. It also takes a page and per_page number for pagination."""
+    if config['SEARCH_FTS_DATABASE']:
+        return config['SEARCH_FTS_DATABASE']
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite':
+        raise RuntimeError('Full-text search defaults to SQLite FTS5 tables in the app database, which is not SQLite. '
+                           'Set ELASTICSEARCH_URL, or SEARCH_FTS_DATABASE to a file on storage that the web and task '
+                           'workers share, or SEARCH_BACKEND to none.')
+    if not url.database or url.database == ':memory:':
+        return ':memory:'
+    # relative paths are relative to the app package, as for Flask-SQLAlchemy
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), url.database)
 
-    # return None if elasticsearch is not configured
-    if not current_app.elasticsearch:
-        return [], 0
 
-    search = current_app.elasticsearch.search(index=index, body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-                                                                 'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+def _words(text):
+    return re.findall(r'\w+', str(text).lower())
+
+
+def search_document(model):
+    """This function returns the document indexed for a searchable object, made of its __searchable__ fields."""
+
+    return {field: getattr(model, field) for field in model.__searchable__}
+
+
+def bulk_index(actions, refresh=False):
+    """
+    This function applies a batch of changes to the search indexes with a single bulk request. Each action is an
+    ('index', index, id, document), ('create', index, id, document) or ('delete', index, id, None) tuple, where create
+    only adds documents that are not in the index yet. If refresh is set, the request returns once the changes are
+    visible to searches. It returns the set of (index, id) pairs whose change failed; errors that fail the whole
+    request, such as Elasticsearch being unreachable, are raised.
+    """
+
+    # return an empty set if full-text search is not configured
+    if not current_app.search_index or not actions:
+        return set()
+
+    body = []
+    for action, index, id, document in actions:
+        body.append({action: {'_index': index, '_id': id}})
+        if document is not None:
+            body.append(document)
+    response = current_app.search_index.bulk(body=body, refresh='wait_for' if refresh else 'false')
+    if not response['errors']:
+        return set()
+    # the items of the response come in the order of the actions; deleting a missing document leaves no error, and
+    # neither does creating a document that is already there
+    failed = set()
+    for (action, index, id, _), item in zip(actions, response['items']):
+        result = item[action]
+        if 'error' in result and not (action == 'create' and result['status'] == 409):
+            failed.add((index, id))
+    return failed
+
+
+def create_index(index):
+    """This function creates a search index, unless it already exists."""
+
+    current_app.search_index.indices.create(index=index, ignore=400)
+
+
+def delete_index(index):
+    """This function deletes a search index, if it exists."""
+
+    current_app.search_index.indices.delete(index=index, ignore=404)
+
+
+def swap_alias(alias, index):
+    """
+    This function points an alias to the given index, and deletes the indexes it pointed to before, in one atomic
+    request, so that searches go from the old indexes to the new one without a gap. An index named like the alias,
+    as created by indexing before aliases were in use, is deleted too.
+    """
+
+    indices = current_app.search_index.indices
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    if indices.exists_alias(name=alias):
+        actions += [{'remove_index': {'index': name}} for name in indices.get_alias(name=alias) if name != index]
+    elif indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    indices.update_aliases(body={'actions': actions})
+
+
+def query_index(index, query, per_page, after=None, before=None, page=None):
+    """
+    This function queries a given index with a given query, for a page of per_page hits in descending order of
+    relevance. Pages are read right after or right before the sort values of a hit with search_after, which costs the
+    same however deep the page is, and page numbers, from links made before cursors, are read with from/size. It
+    returns the hits as (id, sort values) pairs, whether there are more hits beyond the page (before it when reading
+    before a hit), and the total number of hits.
+    """
+
+    # return None if full-text search is not configured
+    if not current_app.search_index:
+        return [], False, 0
+
+    # hits tied on score are ordered by id, so that every hit has distinct sort values; pages before a hit are read in
+    # reverse, and turned back around
+    order = 'asc' if before is not None else 'desc'
+    body = {'query': {'multi_match': {'query': query, 'fields': ['*']}}, 'size': per_page + 1,
+            'sort': [{'_score': order}, {'_id': order}]}
+    if before is not None or after is not None:
+        body['search_after'] = before if before is not None else after
+    else:
+        body['from'] = (page - 1) * per_page if page and page > 0 else 0
+    search = current_app.search_index.search(index=index, body=body)
+    hits = [(int(hit['_id']), hit['sort']) for hit in search['hits']['hits']]
+    more = len(hits) > per_page
+    hits = hits[:per_page]
+    if before is not None:
+        hits.reverse()
+    return hits, more, search['hits']['total']['value']
+
+
+_generations_lock = Lock()
+
+
+def _generation(index, r):
+    """
+    This function returns the generation counter of an index, from Redis, or from this worker while Redis is
+    unreachable. The two kinds of counters are told apart, so that the results cached under one are not mistaken for
+    results cached under the other.
+    """
+
+    if r is not None:
+        try:
+            return 'r{}'.format(int(r.get('search:generation:{}'.format(index)) or 0))
+        except RedisError:
+            redis_failed()
+    return 'l{}'.format(local_store('search_generations').get(index, 0))
+
+
+def bump_generations(indexes):
+    """
+    This function bumps the generation counters of the given indexes, once changes have been written to them, which
+    retires the cached results of the queries on these indexes.
+    """
+
+    with _generations_lock:
+        generations = local_store('search_generations')
+        for index in indexes:
+            generations[index] = generations.get(index, 0) + 1
+    r = get_redis()
+    if r is not None and indexes:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for index in indexes:
+                pipe.incr('search:generation:{}'.format(index))
+            pipe.execute()
+        except RedisError:
+            redis_failed()
+
+
+def cached_query_index(index, query, per_page, after=None, before=None, page=None):
+    """
+    This function returns the same as query_index(), from a cache when possible. Results are cached in an in-process
+    LRU cache, backed by Redis, under the normalized query, the page and the generation counter of the index, which is
+    bumped whenever changes are written to the index, so that cached results are never older than the index. While
+    Redis is unreachable, each worker counts generations on its own, and may then miss the changes written by other
+    workers for up to SEARCH_CACHE_LOCAL_TTL seconds.
+    """
+
+    if not current_app.search_index:
+        return [], False, 0
+
+    r = get_redis()
+    digest = md5(' '.join(query.lower().split()).encode('utf-8')).hexdigest()
+    position = json.dumps([after, before, page], separators=(',', ':'))
+    key = 'search:results:{}:{}:{}:{}:{}'.format(index, _generation(index, r), digest, per_page, position)
+    lru = local_store('search_results', lambda: LRUCache(current_app.config['SEARCH_CACHE_SIZE'],
+                                                         current_app.config['SEARCH_CACHE_LOCAL_TTL']))
+    result = lru.get(key)
+    if result is None and r is not None:
+        try:
+            cached = r.get(key)
+            result = tuple(json.loads(cached)) if cached is not None else None
+        except RedisError:
+            redis_failed()
+            r = None
+    if result is None:
+        result = query_index(index, query, per_page, after=after, before=before, page=page)
+        if r is not None:
+            try:
+                r.set(key, json.dumps(result), ex=current_app.config['SEARCH_CACHE_TTL'])
+            except RedisError:
+                redis_failed()
+    lru.set(key, result)
+    return result
+
+
+class MemoryIndex(object):
+    """
+    This class implements an in-process stand-in for the Elasticsearch client, for the tests, with the bulk(),
+    search() and indices calls made by this module. Documents are split into lowercase words, and scored by the number
+    of occurrences of the words of the query.
+    """
+
+    def __init__(self):
+        self.indexes = defaultdict(dict)
+        self.aliases = {}
+        self.lock = Lock()
+        self.indices = MemoryIndices(self)
+
+    def bulk(self, body, refresh=None):
+        """This method applies a list of bulk actions, and returns a response shaped like that of Elasticsearch."""
+
+        items = []
+        with self.lock:
+            body = iter(body)
+            for line in body:
+                (action, meta), = line.items()
+                index = self.aliases.get(meta['_index'], meta['_index'])
+                documents = self.indexes[index]
+                id = str(meta['_id'])
+                item = {'_index': index, '_id': id}
+                if action == 'create' and id in documents:
+                    next(body)
+                    item.update(status=409, error={'type': 'version_conflict_engine_exception'})
+                elif action in ('index', 'create'):
+                    item['status'] = 200 if id in documents else 201
+                    documents[id] = [word for value in next(body).values() for word in _words(value)]
+                else:
+                    item['status'] = 200 if documents.pop(id, None) is not None else 404
+                items.append({action: item})
+        return {'errors': any('error' in item for item in items), 'items': items}
+
+    def search(self, index, body):
+        """
+        This method runs a multi_match query, sorted by score and id in the order given by the sort of the query, and
+        returns a response shaped like that of Elasticsearch.
+        """
+
+        words = set(_words(body['query']['multi_match']['query']))
+        with self.lock:
+            documents = self.indexes[self.aliases.get(index, index)]
+            scores = [(sum(word in words for word in document), int(id)) for id, document in documents.items()]
+        hits = [hit for hit in scores if hit[0]]
+        total = len(hits)
+        descending = body.get('sort', [{'_score': 'desc'}])[0]['_score'] == 'desc'
+        hits.sort(reverse=descending)
+        if 'search_after' in body:
+            after = tuple(body['search_after'])
+            hits = [hit for hit in hits if (hit < after if descending else hit > after)]
+        start = body.get('from', 0)
+        return {'hits': {'total': {'value': total},
+                         'hits': [{'_id': str(id), '_score': score, 'sort': [score, id]}
+                                  for score, id in hits[start:start + body.get('size', 10)]]}}
+
+
+class MemoryIndices(object):
+    """This class implements the indices calls of MemoryIndex, which manage its indexes and their aliases."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, ignore=None):
+        with self.client.lock:
+            self.client.indexes[index]
+
+    def delete(self, index, ignore=None):
+        with self.client.lock:
+            self.client.indexes.pop(index, None)
+
+    def exists(self, index):
+        return index in self.client.indexes
+
+    def exists_alias(self, name):
+        return name in self.client.aliases
+
+    def get_alias(self, name):
+        return {self.client.aliases[name]: {'aliases': {name: {}}}}
+
+    def update_aliases(self, body):
+        with self.client.lock:
+            for action in body['actions']:
+                (kind, args), = action.items()
+                if kind == 'add':
+                    self.client.indexes[args['index']]
+                    self.client.aliases[args['alias']] = args['index']
+                elif kind == 'remove_index':
+                    self.client.indexes.pop(args['index'], None)
+                    self.client.aliases = {alias: index for alias, index in self.client.aliases.items()
+                                           if index != args['index']}
+
+
+class FTSIndex(object):
+    """
+    This class implements a search backend on SQLite FTS5, for deployments without an Elasticsearch cluster. Each index
+    is a virtual table holding the searchable fields of each document as a single text column, with the id of the
+    document as rowid, and hits are ranked with BM25. The tables live in the SQLite database returned by
+    fts_database(), next to the tables of the app or in a file of their own. The journal mode of the database is
+    switched to WAL if wal is true, which is only done for a file of its own, so that the journal mode of the app
+    database is left as it is.
+    """
+
+    def __init__(self, path, wal=False):
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        if wal:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS search_alias (alias TEXT PRIMARY KEY, target TEXT)')
+        self.lock = RLock()
+        self.indices = FTSIndices(self)
+
+    @staticmethod
+    def table(index):
+        """This method returns the quoted name of the table of an index."""
+
+        return '"fts_{}"'.format(re.sub(r'\W', '_', index))
+
+    def resolve(self, index):
+        """This method returns the name of the index an alias points to, or the given name if it is not an alias."""
+
+        row = self.connection.execute('SELECT target FROM search_alias WHERE alias = ?', (index,)).fetchone()
+        return row[0] if row is not None else index
+
+    def create(self, index):
+        """This method creates the table of an index, unless it exists."""
+
+        self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(content)'.format(self.table(index)))
+
+    def bulk(self, body, refresh=None):
+        """
+        This method applies a list of bulk actions in one transaction, and returns a response shaped like that of
+        Elasticsearch.
+        """
+
+        items = []
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                body = iter(body)
+                for line in body:
+                    (action, meta), = line.items()
+                    index = self.resolve(meta['_index'])
+                    self.create(index)
+                    table = self.table(index)
+                    id = int(meta['_id'])
+                    item = {'_index': index, '_id': str(id)}
+                    exists = self.connection.execute('SELECT 1 FROM {} WHERE rowid = ?'.format(table),
+                                                     (id,)).fetchone() is not None
+                    if action == 'create' and exists:
+                        next(body)
+                        item.update(status=409, error={'type': 'version_conflict_engine_exception'})
+                    elif action in ('index', 'create'):
+                        content = ' '.join(str(value) for value in next(body).values() if value is not None)
+                        self.connection.execute('INSERT OR REPLACE INTO {} (rowid, content) VALUES (?, ?)'.format(
+                            table), (id, content))
+                        item['status'] = 200 if exists else 201
+                    else:
+                        self.connection.execute('DELETE FROM {} WHERE rowid = ?'.format(table), (id,))
+                        item['status'] = 200 if exists else 404
+                    items.append({action: item})
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return {'errors': any('error' in item for item in items), 'items': items}
+
+    def search(self, index, body):
+        """
+        This method runs a multi_match query, which matches the documents that contain any of the words of the query,
+        sorted by BM25 score and id in the order given by the sort of the query, and returns a response shaped like
+        that of Elasticsearch.
+        """
+
+        words = _words(body['query']['multi_match']['query'])
+        if not words:
+            return {'hits': {'total': {'value': 0}, 'hits': []}}
+        match = ' OR '.join('"{}"'.format(word) for word in words)
+        with self.lock:
+            index = self.resolve(index)
+            if not self.indices.exists(index):
+                return {'hits': {'total': {'value': 0}, 'hits': []}}
+            table = self.table(index)
+            total, = self.connection.execute('SELECT count(*) FROM {0} WHERE {0} MATCH ?'.format(table),
+                                             (match,)).fetchone()
+            # BM25 scores are negative in SQLite, the better the lower, so they are negated
+            descending = body.get('sort', [{'_score': 'desc'}])[0]['_score'] == 'desc'
+            sql = 'SELECT rowid, score FROM (SELECT rowid, -bm25({0}) AS score FROM {0} WHERE {0} MATCH ?)'.format(table)
+            params = [match]
+            if 'search_after' in body:
+                sql += ' WHERE (score, rowid) {} (?, ?)'.format('<' if descending else '>')
+                params += body['search_after']
+            sql += ' ORDER BY score {0}, rowid {0} LIMIT ? OFFSET ?'.format('DESC' if descending else 'ASC')
+            rows = self.connection.execute(sql, params + [body.get('size', 10), body.get('from', 0)]).fetchall()
+        return {'hits': {'total': {'value': total},
+                         'hits': [{'_id': str(id), '_score': score, 'sort': [score, id]} for id, score in rows]}}
+
+
+class FTSIndices(object):
+    """This class implements the indices calls of FTSIndex, which manage its indexes and their aliases."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, ignore=None):
+        with self.client.lock:
+            self.client.create(index)
+
+    def delete(self, index, ignore=None):
+        with self.client.lock:
+            self.client.connection.execute('DROP TABLE IF EXISTS {}'.format(self.client.table(index)))
+            self.client.connection.execute('DELETE FROM search_alias WHERE target = ?', (index,))
+
+    def exists(self, index):
+        with self.client.lock:
+            return self.client.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                                  (self.client.table(index).strip('"'),)).fetchone() is not None
+
+    def exists_alias(self, name):
+        with self.client.lock:
+            return self.client.resolve(name) != name
+
+    def get_alias(self, name):
+        with self.client.lock:
+            return {self.client.resolve(name): {'aliases': {name: {}}}}
+
+    def update_aliases(self, body):
+        with self.client.lock:
+            self.client.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for action in body['actions']:
+                    (kind, args), = action.items()
+                    if kind == 'add':
+                        self.client.create(args['index'])
+                        self.client.connection.execute('INSERT OR REPLACE INTO search_alias (alias, target) '
+                                                       'VALUES (?, ?)', (args['alias'], args['index']))
+                    elif kind == 'remove_index':
+                        self.delete(args['index'])
+                self.client.connection.execute('COMMIT')
+            except BaseException:
+                self.client.connection.execute('ROLLBACK')
+                raise
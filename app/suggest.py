@@ -0,0 +1,228 @@
+import re
+import json
+from bisect import bisect_left, insort
+from collections import Counter
+from heapq import nlargest
+from threading import Lock
+from time import time
+from flask import current_app
+from redis.exceptions import RedisError
+from app import db
+from app.cache import get_redis, redis_failed, local_store
+from app.models import User, Post
+
+
+# the Redis stream on which the changes to usernames and post terms committed by any process are announced, for each
+# worker to apply them to its own prefix indexes
+STREAM = 'suggest:changes'
+
+# words shorter than this are not suggested
+MIN_TERM_LENGTH = 3
+
+_lock = Lock()
+
+
+def post_terms(text):
+    """This function returns the set of distinct words of a text that can be suggested, in lowercase."""
+
+    return {word for word in re.findall(r'[^\W\d_]+', (text or '').lower()) if len(word) >= MIN_TERM_LENGTH}
+
+
+class PrefixIndex(object):
+    """
+    This class implements a compact in-memory prefix index over weighted values: a sorted list of (lowercase value,
+    value) pairs, searched with bisect, and a dictionary of the weights of the values.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = dict(weights or {})
+        self.keys = sorted((value.lower(), value) for value in self.weights)
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, value, weight=1):
+        """This method adds weight to a value, and removes the value once its weight falls to zero."""
+
+        with self.lock:
+            if value not in self.weights:
+                if weight <= 0:
+                    return
+                insort(self.keys, (value.lower(), value))
+                self.weights[value] = 0
+            self.weights[value] += weight
+            if self.weights[value] <= 0:
+                self._remove(value)
+
+    def discard(self, value):
+        """This method removes a value, whatever its weight."""
+
+        with self.lock:
+            if value in self.weights:
+                self._remove(value)
+
+    def _remove(self, value):
+        del self.weights[value]
+        del self.keys[bisect_left(self.keys, (value.lower(), value))]
+
+    def complete(self, prefix, limit):
+        """
+        This method returns up to limit values that start with the given prefix, ignoring case, the heaviest first and
+        in alphabetical order among equals.
+        """
+
+        prefix = prefix.lower()
+        with self.lock:
+            start = bisect_left(self.keys, (prefix,))
+            end = bisect_left(self.keys, (prefix + '\U0010ffff',), start)
+            # nlargest() is stable, so values of equal weight stay in alphabetical order
+            return nlargest(limit, (value for _, value in self.keys[start:end]), key=self.weights.get)
+
+
+def _stream_id(id):
+    return tuple(int(part) for part in id.split('-'))
+
+
+def _build(state, r):
+    """
+    This function builds the prefix indexes of this worker from the database: all the usernames, weighted by their
+    number of followers, and the terms of the SUGGEST_REBUILD_POSTS most recent posts, weighted by the number of posts
+    they appear in. Changes announced after the last one in the stream at this time are applied by _sync().
+    """
+
+    state['last_id'] = '0-0'
+    if r is not None:
+        latest = r.xrevrange(STREAM, count=1)
+        if latest:
+            state['last_id'] = latest[0][0].decode('ascii')
+    state['users'] = PrefixIndex({username: followers_count + 1 for username, followers_count in
+                                  db.session.query(User.username, User.followers_count)})
+    terms = Counter()
+    for body, in db.session.query(Post.body).order_by(Post.timestamp.desc()).limit(
+            current_app.config['SUGGEST_REBUILD_POSTS']):
+        terms.update(post_terms(body))
+    state['terms'] = PrefixIndex(terms)
+
+
+def _apply(state, changes):
+    for index, value, weight in changes:
+        if weight is None:
+            state[index].discard(value)
+        else:
+            state[index].add(value, weight)
+
+
+def _sync():
+    """
+    This function returns the prefix indexes of this worker, building them on first use, and catching up with the
+    changes announced on the stream at most every SUGGEST_SYNC_SECONDS. The indexes are rebuilt if the stream has been
+    trimmed past the last change applied.
+    """
+
+    state = local_store('suggest')
+    with _lock:
+        if state and time() < state['synced'] + current_app.config['SUGGEST_SYNC_SECONDS']:
+            return state
+        r = get_redis()
+        try:
+            if not state:
+                _build(state, r)
+            elif r is not None:
+                pipe = r.pipeline(transaction=False)
+                pipe.xlen(STREAM)
+                pipe.xrange(STREAM, count=1)
+                pipe.xread({STREAM: state['last_id']})
+                length, first, entries = pipe.execute()
+                if length >= current_app.config['SUGGEST_STREAM_LENGTH'] and first and \
+                        _stream_id(first[0][0].decode('ascii')) > _stream_id(state['last_id']):
+                    _build(state, r)
+                else:
+                    for id, fields in (entries[0][1] if entries else []):
+                        _apply(state, json.loads(fields[b'changes']))
+                        state['last_id'] = id.decode('ascii')
+        except RedisError:
+            redis_failed()
+            if 'users' not in state:
+                _build(state, None)
+        state['synced'] = time()
+    return state
+
+
+def suggest(q, limit):
+    """
+    This function returns the usernames that start with the query, and the post terms that start with its last word,
+    up to limit of each.
+    """
+
+    state = _sync()
+    words = q.split()
+    if not words:
+        return {'users': [], 'terms': []}
+    return {'users': state['users'].complete(q.strip(), limit) if len(words) == 1 else [],
+            'terms': state['terms'].complete(words[-1], limit)}
+
+
+def record_changes(session, flush_context):
+    """
+    This function records the changes to usernames and post terms made by the objects being flushed, to be announced
+    once the transaction is committed.
+    """
+
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, User):
+            changes.append(('users', obj.username, 1))
+        elif isinstance(obj, Post):
+            changes += [('terms', term, 1) for term in post_terms(obj.body)]
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes.append(('users', obj.username, None))
+        elif isinstance(obj, Post):
+            changes += [('terms', term, -1) for term in post_terms(obj.body)]
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            history = db.inspect(obj).attrs.username.history
+            changes += [('users', username, None) for username in history.deleted or ()]
+            changes += [('users', username, 1) for username in history.added or ()]
+        elif isinstance(obj, Post):
+            history = db.inspect(obj).attrs.body.history
+            changes += [('terms', term, -1) for body in history.deleted or () for term in post_terms(body)]
+            changes += [('terms', term, 1) for body in history.added or () for term in post_terms(body)]
+    if changes:
+        session.info.setdefault('suggest_changes', []).extend(changes)
+
+
+def announce_changes(session):
+    """
+    This function announces the changes recorded in a transaction that has just been committed on the stream, from
+    which every worker applies them, this one included. While Redis is unreachable, they are applied to the prefix
+    indexes of this worker only.
+    """
+
+    changes = session.info.pop('suggest_changes', None)
+    if not changes:
+        return
+    r = get_redis()
+    if r is not None:
+        try:
+            r.xadd(STREAM, {'changes': json.dumps(changes)}, maxlen=current_app.config['SUGGEST_STREAM_LENGTH'],
+                   approximate=False)
+            return
+        except RedisError:
+            redis_failed()
+    state = local_store('suggest')
+    if 'users' in state:
+        _apply(state, changes)
+
+
+def discard_changes(session):
+    """This function discards the changes recorded in a transaction that has been rolled back."""
+
+    session.info.pop('suggest_changes', None)
+
+
+# set up event handlers that announce the changes to usernames and post terms once they are committed
+db.event.listen(db.session, 'after_flush', record_changes)
+db.event.listen(db.session, 'after_commit', announce_changes)
+db.event.listen(db.session, 'after_rollback', discard_changes)
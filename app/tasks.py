@@ -4,8 +4,10 @@ import json
 from rq import get_current_job
 from flask import render_template
 from app import db, create_app
-from app.models import User, Post, Task
+from app.models import User, Post, Task, SearchOutbox
 from app.email import send_mail
+from app.last_seen import flush_last_seen as _flush_last_seen
+from app.maintenance import compact as _compact, schedule_compaction
 
 
 app = create_app()
@@ -46,6 +48,7 @@ def _set_task_progress(progress):
         # flag the task as completed if progress is greater than 100
         if progress >= 100:
             task.complete = True
+            task.completed_at = time.time()
 
         # commit database changes
         db.session.commit()
@@ -88,3 +91,96 @@ def export_posts(user_id):
     finally:
         _set_task_progress(100)
 
+
+
+def fan_out_post(post_id, user_id, score):
+    """
+    This function pushes a new post into the home timelines of the followers 
+    of its author.
+    """
+
+    try:
+        Post.fan_out(post_id, user_id, score)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def push_recent_posts(user_id):
+    """
+    This function pushes the recent posts of a user who is no longer a pull 
+    source into the home timelines of its followers.
+    """
+
+    try:
+        User.push_recent_posts(user_id)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def backfill_timeline(user_id, followed_id):
+    """
+    This function merges the recent posts of a newly followed user into the 
+    home timeline of the given user.
+    """
+
+    try:
+        User.query.get(user_id).backfill_timeline(User.query.get(followed_id))
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def purge_timeline(user_id, followed_id):
+    """
+    This function removes the posts of an unfollowed user from the home 
+    timeline of the given user.
+    """
+
+    try:
+        User.query.get(user_id).purge_timeline(User.query.get(followed_id))
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def flush_last_seen():
+    """
+    This function writes the last_seen times buffered by the web workers to 
+    the database in a single bulk UPDATE.
+    """
+
+    try:
+        app.logger.info('Flushed the last_seen times of {} users'.format(_flush_last_seen()))
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def drain_search_outbox():
+    """
+    This function applies the changes waiting in the search outbox to the 
+    search indexes in bulk, and schedules a retry of the ones that failed.
+    """
+
+    try:
+        applied, retry_in = SearchOutbox.drain()
+        app.logger.info('Applied {} changes to the search indexes'.format(applied))
+        if retry_in is not None:
+            SearchOutbox.schedule_drain(retry_in)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def compact():
+    """
+    This function deletes the completed tasks and the notifications that are 
+    past their retention period, logs how many rows it removed and how long it 
+    took, and schedules its next run.
+    """
+
+    try:
+        report = _compact()
+        app.logger.info('Compaction removed {tasks} tasks and {notifications} '
+                        'notifications in {seconds:.3f} s'.format(**report))
+        return report
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        schedule_compaction(reschedule=True)
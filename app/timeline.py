@@ -0,0 +1,241 @@
+from bisect import insort, bisect_left, bisect_right
+from datetime import timezone
+from flask import current_app
+from redis.exceptions import RedisError
+from app.cache import get_redis, redis_failed, local_store
+
+
+# A post id that never exists, stored with the lowest score at the tail of a timeline. As long as a timeline still
+# holds it, the timeline contains every post of the user's feed. It is the first entry to go when a timeline is
+# trimmed, so a trimmed timeline is automatically known to be incomplete.
+SENTINEL = 0
+SENTINEL_SCORE = -1.0
+
+# push a post into a timeline only if that timeline is materialized, then trim the timeline to its maximum length
+_PUSH_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('zadd', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('zremrangebyrank', KEYS[1], 0, -(tonumber(ARGV[1]) + 2))
+end
+"""
+
+# add (score, post id) pairs to a materialized timeline, skipping entries older than the tail of an incomplete
+# timeline so that the cached entries always stay a gap-free prefix of the feed
+_BACKFILL_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return
+end
+local oldest = nil
+if not redis.call('zscore', KEYS[1], ARGV[2]) then
+    oldest = tonumber(redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')[2])
+end
+for i = 3, #ARGV, 2 do
+    if oldest == nil or tonumber(ARGV[i]) >= oldest then
+        redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('zremrangebyrank', KEYS[1], 0, -(tonumber(ARGV[1]) + 2))
+"""
+
+# The timeline shared by all users, which holds the most recent posts of every user for the explore page. It is kept
+# like the home timelines, keyed by this name instead of a user id, and trimmed to EXPLORE_TIMELINE_LENGTH posts.
+GLOBAL = 'global'
+
+
+def timestamp_score(timestamp):
+    """This function converts a naive UTC datetime into the score used to order timeline entries."""
+
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _key(user_id):
+    return 'timeline:{}'.format(user_id)
+
+
+def _member(post_id):
+    # zero-padded, so that Redis orders posts with equal scores by id
+    return '{:012d}'.format(post_id)
+
+
+def _local_push(timeline, score, post_id, max_length):
+    """This function inserts an entry into an in-process timeline, which is a list of (score, post id) kept sorted."""
+
+    if (score, post_id) not in timeline:
+        insort(timeline, (score, post_id))
+    if len(timeline) > max_length + 1:
+        del timeline[:len(timeline) - max_length - 1]
+
+
+def add_to_timelines(user_ids, post_id, score, max_length=None):
+    """
+    This function pushes a post into the materialized timelines of the given users, which are trimmed to max_length
+    posts, or to TIMELINE_LENGTH posts by default.
+    """
+
+    max_length = max_length or current_app.config['TIMELINE_LENGTH']
+    r = get_redis()
+    if r is not None:
+        try:
+            push = r.register_script(_PUSH_SCRIPT)
+            pipe = r.pipeline(transaction=False)
+            for user_id in user_ids:
+                push(keys=[_key(user_id)], args=[max_length, score, _member(post_id)], client=pipe)
+            pipe.execute()
+            return
+        except RedisError:
+            redis_failed()
+
+    timelines = local_store('timelines')
+    for user_id in user_ids:
+        if user_id in timelines:
+            _local_push(timelines[user_id], score, post_id, max_length)
+
+
+def backfill_timeline(user_id, entries):
+    """
+    This function merges (post id, score) entries, such as the recent posts of a newly followed user, into a
+    materialized timeline.
+    """
+
+    max_length = current_app.config['TIMELINE_LENGTH']
+    r = get_redis()
+    if r is not None:
+        try:
+            args = [max_length, _member(SENTINEL)]
+            for post_id, score in entries:
+                args += [score, _member(post_id)]
+            r.register_script(_BACKFILL_SCRIPT)(keys=[_key(user_id)], args=args)
+            return
+        except RedisError:
+            redis_failed()
+
+    timeline = local_store('timelines').get(user_id)
+    if timeline is None:
+        return
+    oldest = None if timeline[0][1] == SENTINEL else timeline[0][0]
+    for post_id, score in entries:
+        if oldest is None or score >= oldest:
+            _local_push(timeline, score, post_id, max_length)
+
+
+def remove_from_timelines(user_ids, post_ids):
+    """This function removes posts from the materialized timelines of the given users."""
+
+    if not post_ids:
+        return
+    r = get_redis()
+    if r is not None:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.zrem(_key(user_id), *[_member(post_id) for post_id in post_ids])
+            pipe.execute()
+            return
+        except RedisError:
+            redis_failed()
+
+    timelines = local_store('timelines')
+    post_ids = set(post_ids)
+    for user_id in user_ids:
+        if user_id in timelines:
+            timelines[user_id][:] = [entry for entry in timelines[user_id] if entry[1] not in post_ids]
+
+
+def set_timeline(user_id, entries, complete):
+    """
+    This function materializes a timeline from (post id, score) entries, replacing any previous version. The complete
+    flag tells whether the entries cover the whole feed of the user.
+    """
+
+    if complete:
+        entries = list(entries) + [(SENTINEL, SENTINEL_SCORE)]
+    r = get_redis()
+    if r is not None:
+        try:
+            pipe = r.pipeline()
+            pipe.delete(_key(user_id))
+            if entries:
+                pipe.zadd(_key(user_id), {_member(post_id): score for post_id, score in entries})
+            pipe.execute()
+            return
+        except RedisError:
+            redis_failed()
+
+    local_store('timelines')[user_id] = sorted((score, post_id) for post_id, score in entries)
+
+
+def clear_timeline(user_id):
+    """This function drops a materialized timeline, so that it gets rebuilt from the database on the next read."""
+
+    r = get_redis()
+    if r is not None:
+        try:
+            r.delete(_key(user_id))
+            return
+        except RedisError:
+            redis_failed()
+
+    local_store('timelines').pop(user_id, None)
+
+
+def get_timeline(user_id, count, after=None, before=None):
+    """
+    This function reads up to count post ids from a materialized timeline, newest first. Given an after or before
+    cursor of (score, post id), it reads the entries right after (older than) or right before (newer than) the cursor.
+    It returns None if the timeline is not materialized. Otherwise it returns the list of post ids, and whether the
+    timeline covers the whole range read: reading after a cursor, whether no older posts exist past the cached ones;
+    reading before a cursor, whether the cursor is not older than the cached entries.
+    """
+
+    r = get_redis()
+    if r is not None:
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.exists(_key(user_id))
+            pipe.zrange(_key(user_id), 0, 0, withscores=True)
+            if after is not None:
+                pipe.zrevrangebyscore(_key(user_id), after[0], after[0], withscores=True)
+                pipe.zrevrangebyscore(_key(user_id), '({!r}'.format(after[0]), '-inf', start=0, num=count,
+                                      withscores=True)
+            elif before is not None:
+                pipe.zrangebyscore(_key(user_id), before[0], before[0], withscores=True)
+                pipe.zrangebyscore(_key(user_id), '({!r}'.format(before[0]), '+inf', start=0, num=count,
+                                   withscores=True)
+            else:
+                pipe.zrevrange(_key(user_id), 0, count - 1, withscores=True)
+            exists, oldest, *ranges = pipe.execute()
+        except RedisError:
+            redis_failed()
+        else:
+            if not exists:
+                return None
+            oldest = (oldest[0][1], int(oldest[0][0])) if oldest else None
+            # entries sharing the score of the cursor are filtered on their post id
+            entries = sorted(((score, int(member)) for entries in ranges for member, score in entries), reverse=True)
+            if after is not None:
+                entries = [entry for entry in entries if entry < tuple(after)][:count]
+            elif before is not None:
+                entries = [entry for entry in entries if entry > tuple(before)][-count:]
+            return _read_result(entries, oldest, after, before)
+
+    timeline = local_store('timelines').get(user_id)
+    if timeline is None:
+        return None
+    if before is not None:
+        start = bisect_right(timeline, tuple(before))
+        entries = timeline[start:start + count][::-1]
+    else:
+        end = bisect_left(timeline, tuple(after)) if after is not None else len(timeline)
+        entries = timeline[max(end - count, 0):end][::-1]
+    return _read_result(entries, timeline[0] if timeline else None, after, before)
+
+
+def _read_result(entries, oldest, after, before):
+    """This function turns the entries read by get_timeline() into its result, given the oldest entry held."""
+
+    complete = oldest is not None and oldest[1] == SENTINEL
+    if before is not None:
+        covered = complete or (oldest is not None and tuple(before) >= oldest)
+    else:
+        covered = complete
+    return [post_id for _, post_id in entries if post_id != SENTINEL], covered
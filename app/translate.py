@@ -1,20 +1,149 @@
-import json
+import sqlite3
+from collections import Counter
+from hashlib import sha256
+from threading import Lock
+from time import time
 import requests
 from flask import current_app
 from flask_babel import _
+from redis.exceptions import RedisError
+from app.cache import get_redis, redis_failed, local_store
+
+
+# the Redis hash counting the lookups of the translation cache of all workers: 'redis_hits' and 'store_hits' for the
+# translations found in Redis and in the SQLite store, 'misses' for the ones sent to the translator API, and 'errors'
+# for the calls to the API that failed
+METRICS_KEY = 'translation:metrics'
+
+
+class TranslationStore(object):
+    """
+    This class implements the persistent tier of the translation cache, a table in a SQLite database of its own, shared
+    by the workers of a host, whatever database the app uses.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS translation (text_hash TEXT, source_language TEXT, '
+                                'dest_language TEXT, translation TEXT, created REAL, '
+                                'PRIMARY KEY (text_hash, source_language, dest_language))')
+        self.lock = Lock()
+
+    def get(self, key):
+        """This method returns the translation stored under a (text hash, source, destination) key, or None."""
+
+        with self.lock:
+            row = self.connection.execute('SELECT translation FROM translation WHERE text_hash = ? AND '
+                                          'source_language = ? AND dest_language = ?', key).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key, translation):
+        """This method stores a translation under a (text hash, source, destination) key."""
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO translation VALUES (?, ?, ?, ?, ?)',
+                                    key + (translation, time()))
+
+
+def _store():
+    return local_store('translations', lambda: TranslationStore(current_app.config['TRANSLATION_CACHE_DATABASE']))
+
+
+def _count(name):
+    """This function counts a lookup of the translation cache, in this worker and in Redis."""
+
+    local_store('translation_metrics', Counter)[name] += 1
+    r = get_redis()
+    if r is not None:
+        try:
+            r.hincrby(METRICS_KEY, name)
+        except RedisError:
+            redis_failed()
+
+
+def translation_metrics():
+    """
+    This function returns the counts of the lookups of the translation cache, of all workers, or of this worker only
+    while Redis is unreachable.
+    """
+
+    metrics = Counter(local_store('translation_metrics', Counter))
+    r = get_redis()
+    if r is not None:
+        try:
+            metrics = Counter({name.decode('utf-8'): int(count) for name, count in r.hgetall(METRICS_KEY).items()})
+        except RedisError:
+            redis_failed()
+    return {name: metrics[name] for name in ('redis_hits', 'store_hits', 'misses', 'errors')}
+
+
+def cached_translation(key):
+    """
+    This function returns the translation cached under a (text hash, source, destination) key, from Redis or else
+    from the SQLite store, which then refills Redis, or None if it is not cached.
+    """
+
+    redis_key = 'translation:{}:{}:{}'.format(*key)
+    r = get_redis()
+    if r is not None:
+        try:
+            translation = r.get(redis_key)
+            if translation is not None:
+                _count('redis_hits')
+                return translation.decode('utf-8')
+        except RedisError:
+            redis_failed()
+            r = None
+    translation = _store().get(key)
+    if translation is not None:
+        _count('store_hits')
+        if r is not None:
+            try:
+                r.set(redis_key, translation, ex=current_app.config['TRANSLATION_REDIS_TTL'])
+            except RedisError:
+                redis_failed()
+    return translation
+
+
+def cache_translation(key, translation):
+    """This function caches a translation under a (text hash, source, destination) key, in Redis and in the store."""
+
+    _store().set(key, translation)
+    r = get_redis()
+    if r is not None:
+        try:
+            r.set('translation:{}:{}:{}'.format(*key), translation, ex=current_app.config['TRANSLATION_REDIS_TTL'])
+        except RedisError:
+            redis_failed()
 
 
 def translate(text, source_language, dest_language):
-    """This function translates a given piece of input text, using Microsoft's translator API."""
+    """
+    This function translates a given piece of input text, from the translation cache when it has been translated
+    before, and otherwise using Microsoft's translator API.
+    """
+
+    key = (sha256(text.encode('utf-8')).hexdigest(), source_language, dest_language)
+    translation = cached_translation(key)
+    if translation is not None:
+        return translation
 
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
         return _("Error: the translation service is not configured.")
+    _count('misses')
     auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
             'Ocp-Apim-Subscription-Region': 'global'}
-    r = requests.post('https://api.cognitive.microsofttranslator.com'
-                      '/translate?api-version=3.0&from={}&to={}'.format(source_language, dest_language),
-                      headers=auth, json=[{'Text': text}])
-    if r.status_code != 200:
+    try:
+        r = requests.post(current_app.config['MS_TRANSLATOR_URL'] +
+                          '/translate?api-version=3.0&from={}&to={}'.format(source_language, dest_language),
+                          headers=auth, json=[{'Text': text}], timeout=current_app.config['MS_TRANSLATOR_TIMEOUT'])
+    except requests.RequestException:
+        r = None
+    if r is None or r.status_code != 200:
+        _count('errors')
         return _("Error: the translation service failed.")
-    
-    return r.json()[0]['translations'][0]['text']
+
+    translation = r.json()[0]['translations'][0]['text']
+    cache_translation(key, translation)
+    return translation
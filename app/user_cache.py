@@ -0,0 +1,115 @@
+from collections import Counter
+from threading import Lock
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from app import db
+from app.cache import get_redis, redis_failed, local_store, LRUCache
+
+
+# the Redis channel on which workers announce the ids of users whose cached snapshots are out of date
+CHANNEL = 'user_cache:invalidate'
+
+_lock = Lock()
+# guards the snapshots of the users against an invalidation slipping in between the check and the fill of a snapshot
+_generation_lock = Lock()
+
+
+def _lru():
+    return local_store('users', lambda: LRUCache(current_app.config['USER_CACHE_SIZE'],
+                                                 current_app.config['USER_CACHE_TTL']))
+
+
+def _generations():
+    # the number of invalidations of each user seen by this worker, and under None the number of times all the
+    # snapshots were dropped
+    return local_store('user_generations', Counter)
+
+
+def _drop(lru, generations, user_ids):
+    with _generation_lock:
+        for user_id in user_ids:
+            generations[user_id] += 1
+            lru.delete(user_id)
+
+
+def _subscribe():
+    """
+    This function makes sure that this worker listens to the invalidations announced by the other workers, in a
+    background thread. If the thread has died since, for instance because Redis went away, snapshots may have missed
+    invalidations, so they are all dropped before listening again.
+    """
+
+    with _lock:
+        thread = current_app.local_stores.get('users_subscriber')
+        if thread is not None and thread.is_alive():
+            return
+        r = get_redis()
+        if r is None:
+            return
+        lru = _lru()
+        generations = _generations()
+        if thread is not None:
+            _drop(lru, generations, [None])
+            lru.clear()
+
+        def invalidate(message):
+            _drop(lru, generations, [int(user_id) for user_id in message['data'].split(b',')])
+
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{CHANNEL: invalidate})
+            current_app.local_stores['users_subscriber'] = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except RedisError:
+            redis_failed()
+
+
+def load_cached_user(model, user_id):
+    """
+    This function returns the user with the given id, attached to the current session, or None if there is none. The
+    user is rebuilt from a snapshot cached in this worker when possible, which saves a query. Snapshots hold the columns
+    of the user except the ones listed in model.__uncached__, which change too often to be cached, and are loaded
+    from the database only if they are accessed. A snapshot is not cached if the user was invalidated while it was
+    being loaded, as it may predate the change.
+    """
+
+    user = db.session.identity_map.get(identity_key(model, user_id))
+    if user is not None:
+        return user
+
+    _subscribe()
+    snapshot = _lru().get(user_id)
+    if snapshot is None:
+        generations = _generations()
+        generation = (generations[None], generations[user_id])
+        user = model.query.get(user_id)
+        if user is not None:
+            snapshot = {column.key: getattr(user, column.key) for column in model.__table__.columns
+                        if column.key not in model.__uncached__}
+            with _generation_lock:
+                if (generations[None], generations[user_id]) == generation:
+                    _lru().set(user_id, snapshot)
+        return user
+
+    user = model(**snapshot)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate_users(user_ids):
+    """
+    This function drops the cached snapshots of the given users from this worker, and announces the change to the
+    other workers. Snapshots that miss the announcement, while Redis is unreachable, expire after USER_CACHE_TTL
+    seconds.
+    """
+
+    if not user_ids:
+        return
+    _drop(_lru(), _generations(), user_ids)
+    r = get_redis()
+    if r is not None:
+        try:
+            r.publish(CHANNEL, ','.join(str(user_id) for user_id in user_ids))
+        except RedisError:
+            redis_failed()
@@ -0,0 +1,178 @@
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter, time
+from app import create_app, db
+from app.models import User, Post, followers
+from app.search import make_search_index, bulk_index, query_index, create_index, delete_index
+from app.suggest import suggest
+from config import TestConfig
+
+
+def build_follow_graph(celebrities, fans, posts_per_user):
+    """
+    This function fills the database with a synthetic follow graph: every fan follows every celebrity and the fan next
+    to it, and every user has written posts_per_user posts. The counters are set directly, as follow() would.
+    """
+
+    users = [User(username='celebrity{}'.format(i), email='celebrity{}@example.com'.format(i))
+             for i in range(celebrities)]
+    users += [User(username='fan{}'.format(i), email='fan{}@example.com'.format(i)) for i in range(fans)]
+    db.session.add_all(users)
+    db.session.flush()
+    pairs = [(fan.id, celebrity.id) for fan in users[celebrities:] for celebrity in users[:celebrities]]
+    pairs += [(fan.id, users[celebrities + (i + 1) % fans].id) for i, fan in enumerate(users[celebrities:])]
+    db.session.execute(followers.insert(), [{'follower_id': follower_id, 'followed_id': followed_id}
+                                            for follower_id, followed_id in pairs])
+    now = datetime.utcnow()
+    db.session.add_all([Post(body='post {}'.format(i), author=user, timestamp=now - timedelta(minutes=i))
+                        for user in users for i in range(posts_per_user)])
+    db.session.commit()
+    User.reconcile_counters()
+    db.session.commit()
+    return users
+
+
+def timed(function, repeat):
+    """This function returns the mean run time of function over repeat calls, in milliseconds."""
+
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - start) * 1000 / repeat
+
+
+def bench_feed(threshold, celebrities=5, fans=500, posts_per_user=20, repeat=50):
+    """
+    This function measures the cost of writing a post as a celebrity and of reading the first home timeline page of a
+    fan, with the given FEED_PULL_THRESHOLD. A threshold above the number of fans gives a pure push feed.
+    """
+
+    app = create_app(TestConfig)
+    app.config['FEED_PULL_THRESHOLD'] = threshold
+    with app.app_context():
+        db.create_all()
+        users = build_follow_graph(celebrities, fans, posts_per_user)
+        celebrity, fan = users[0], users[celebrities]
+        fan.timeline(app.config['POSTS_PER_PAGE'])
+
+        def write():
+            db.session.add(Post(body='new post', author=celebrity))
+            db.session.commit()
+
+        def read():
+            db.session.expire_all()
+            fan.timeline(app.config['POSTS_PER_PAGE'])
+
+        results = timed(write, repeat), timed(read, repeat)
+        db.session.remove()
+        db.drop_all()
+    return results
+
+
+def bench_render(urls=('/index', '/explore', '/search?q=post'), per_page=25, repeat=20):
+    """
+    This function measures the time to serve the given pages with the post fragment cache cold, emptied before every
+    request, and warm.
+    """
+
+    app = create_app(TestConfig)
+    app.config.update(WTF_CSRF_ENABLED=False, POSTS_PER_PAGE=per_page)
+    results = {}
+    with app.app_context():
+        db.create_all()
+        users = build_follow_graph(5, 20, per_page)
+        users[5].set_password('cat')
+        db.session.commit()
+        client = app.test_client()
+        client.post('/auth/login', data={'username': users[5].username, 'password': 'cat'})
+        for url in urls:
+            client.get(url)
+
+            def cold():
+                app.local_stores.pop('post_fragments', None)
+                client.get(url)
+
+            results[url] = timed(cold, repeat), timed(lambda: client.get(url), repeat)
+        db.session.remove()
+        db.drop_all()
+    return results
+
+
+def bench_search(backends=('fts', 'memory'), documents=20000, queries=200, batch_size=500, seed=42):
+    """
+    This function measures the indexing throughput, in documents per second, and the mean query latency, in
+    milliseconds, of the given search backends on the same seeded corpus of random posts. Elasticsearch is measured
+    too when ELASTICSEARCH_URL is set.
+    """
+
+    rng = random.Random(seed)
+    vocabulary = ['word{}'.format(i) for i in range(5000)]
+    corpus = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(5, 40))) for _ in range(documents)]
+    terms = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 3))) for _ in range(queries)]
+
+    app = create_app(TestConfig)
+    if app.config['ELASTICSEARCH_URL']:
+        backends = tuple(backends) + ('elasticsearch',)
+    results = {}
+    with app.app_context(), tempfile.TemporaryDirectory() as directory:
+        for backend in backends:
+            app.search_index = make_search_index(dict(app.config, SEARCH_BACKEND=backend,
+                                                      SEARCH_FTS_DATABASE=os.path.join(directory, 'search.db')))
+            index = 'bench-{}'.format(int(time()))
+            create_index(index)
+            start = perf_counter()
+            for i in range(0, documents, batch_size):
+                bulk_index([('index', index, id, {'body': body})
+                            for id, body in enumerate(corpus[i:i + batch_size], start=i + 1)])
+            throughput = documents / (perf_counter() - start)
+            if backend == 'elasticsearch':
+                app.search_index.indices.refresh(index=index)
+            queries_left = iter(terms)
+            latency = timed(lambda: query_index(index, next(queries_left), 25), queries)
+            delete_index(index)
+            results[backend] = throughput, latency
+    return results
+
+
+def bench_suggest(users=2000, posts=50000, queries=2000, seed=42):
+    """
+    This function measures the median and 99th percentile latency of search suggestions, in milliseconds, over random
+    prefixes of one to four letters, with prefix indexes built from a seeded corpus of random users and posts.
+    """
+
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(20000)]
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+        authors = [User(username='{}{}'.format(rng.choice(vocabulary), i), email='user{}@example.com'.format(i))
+                   for i in range(users)]
+        db.session.add_all(authors)
+        db.session.add_all([Post(body=' '.join(rng.choice(vocabulary) for _ in range(rng.randint(5, 30))),
+                                 author=rng.choice(authors)) for _ in range(posts)])
+        db.session.commit()
+        suggest('a', 8)
+        latencies = []
+        for _ in range(queries):
+            prefix = ''.join(rng.choice(letters) for _ in range(rng.randint(1, 4)))
+            start = perf_counter()
+            suggest(prefix, 8)
+            latencies.append((perf_counter() - start) * 1000)
+        db.session.remove()
+        db.drop_all()
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100]
+
+
+if __name__ == '__main__':
+    for name, threshold in (('push', 10 ** 9), ('hybrid', 100)):
+        write, read = bench_feed(threshold)
+        print('{:8} post write: {:8.2f} ms   home page read: {:8.2f} ms'.format(name, write, read))
+    for url, (cold, warm) in bench_render().items():
+        print('{:16} cold fragment cache: {:8.2f} ms   warm: {:8.2f} ms'.format(url, cold, warm))
+    for backend, (throughput, latency) in bench_search().items():
+        print('{:16} indexing: {:8.0f} documents/s   query: {:8.2f} ms'.format(backend, throughput, latency))
+    print('suggest          p50: {:8.3f} ms   p99: {:8.3f} ms'.format(*bench_suggest()))
@@ -9,4 +9,7 @@ while true; do
     sleep 5
 done
 flask translate compile
-exec gunicorn -b :5000  --access-logfile - --error-logfile - microblog:app
+# the compaction job reschedules itself, on workers started with --with-scheduler
+flask maintenance schedule
+# gevent workers hold the long-lived notification streams without tying up a process each
+exec gunicorn -b :5000 -k gevent --worker-connections 1000 --access-logfile - --error-logfile - microblog:app
@@ -21,10 +21,101 @@ class Config:
     POSTS_PER_PAGE = 3
     LANGUAGES = ['en', 'zh']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or 'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_TIMEOUT = int(os.environ.get('MS_TRANSLATOR_TIMEOUT') or 10)
+    # translations are cached by the hash of their text and their language pair, for TRANSLATION_REDIS_TTL seconds in
+    # Redis, and for good in a table of the TRANSLATION_CACHE_DATABASE SQLite file
+    TRANSLATION_REDIS_TTL = int(os.environ.get('TRANSLATION_REDIS_TTL') or 7 * 24 * 3600)
+    TRANSLATION_CACHE_DATABASE = os.environ.get('TRANSLATION_CACHE_DATABASE') or \
+        os.path.join(basedir, 'translations.db')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # the full-text search backend, 'elasticsearch', 'fts' (SQLite FTS5), 'memory' or 'none' (see app/search.py); by
+    # default Elasticsearch if ELASTICSEARCH_URL is set, and otherwise FTS5 tables in the app database if it is SQLite,
+    # or in the SEARCH_FTS_DATABASE file, which the web and task workers must share
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_FTS_DATABASE = os.environ.get('SEARCH_FTS_DATABASE')
+    # changes to searchable objects go through an outbox table, drained into the search index in bulk requests of
+    # SEARCH_OUTBOX_BATCH_SIZE documents; failed changes are retried after SEARCH_OUTBOX_RETRY_SECONDS, doubled on
+    # every attempt up to SEARCH_OUTBOX_MAX_RETRY_SECONDS
+    SEARCH_OUTBOX_BATCH_SIZE = int(os.environ.get('SEARCH_OUTBOX_BATCH_SIZE') or 500)
+    SEARCH_OUTBOX_RETRY_SECONDS = int(os.environ.get('SEARCH_OUTBOX_RETRY_SECONDS') or 5)
+    SEARCH_OUTBOX_MAX_RETRY_SECONDS = int(os.environ.get('SEARCH_OUTBOX_MAX_RETRY_SECONDS') or 600)
+    # search results are cached in each worker for up to SEARCH_CACHE_LOCAL_TTL seconds, and in Redis for up to
+    # SEARCH_CACHE_TTL seconds, until changes are written to the index
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_LOCAL_TTL = int(os.environ.get('SEARCH_CACHE_LOCAL_TTL') or 10)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    # search suggestions are answered from in-memory prefix indexes in each worker, built from the usernames and the
+    # terms of the SUGGEST_REBUILD_POSTS most recent posts, and kept up to date every SUGGEST_SYNC_SECONDS from a Redis
+    # stream of the last SUGGEST_STREAM_LENGTH changes
+    SUGGEST_LIMIT = int(os.environ.get('SUGGEST_LIMIT') or 8)
+    SUGGEST_MAX_AGE = int(os.environ.get('SUGGEST_MAX_AGE') or 60)
+    SUGGEST_REBUILD_POSTS = int(os.environ.get('SUGGEST_REBUILD_POSTS') or 50000)
+    SUGGEST_SYNC_SECONDS = float(os.environ.get('SUGGEST_SYNC_SECONDS') or 1)
+    SUGGEST_STREAM_LENGTH = int(os.environ.get('SUGGEST_STREAM_LENGTH') or 10000)
+    # 'flask search reindex' reads SEARCH_REINDEX_BATCH_SIZE rows at a time, and sends them to the search index from
+    # SEARCH_REINDEX_WORKERS threads
+    SEARCH_REINDEX_BATCH_SIZE = int(os.environ.get('SEARCH_REINDEX_BATCH_SIZE') or 1000)
+    SEARCH_REINDEX_WORKERS = int(os.environ.get('SEARCH_REINDEX_WORKERS') or 4)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     NOTIFICATION_INTERVAL_SECONDS = \
         int(os.environ.get('NOTIFICATION_INTERVAL_SECONDS') or 10)
+    # SQL statements taking at least this many milliseconds go to logs/slow_queries.log; the number and duration of
+    # the statements of each request are logged at SQL_STATS_LOG_LEVEL, and the slowest SQL_SLOWEST_COUNT of them in
+    # debug mode
+    SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS') or 100)
+    SQL_SLOWEST_COUNT = int(os.environ.get('SQL_SLOWEST_COUNT') or 3)
+    SQL_STATS_LOG_LEVEL = os.environ.get('SQL_STATS_LOG_LEVEL') or 'INFO'
+    # notifications are streamed to browsers over Server-Sent Events, fed by Redis pub/sub ('redis') or, within a
+    # single process, by an in-memory broker ('local'); streams are closed after NOTIFICATION_STREAM_TIMEOUT seconds,
+    # for browsers to reconnect, and kept alive with a comment every NOTIFICATION_STREAM_KEEPALIVE seconds
+    NOTIFICATION_BROKER = os.environ.get('NOTIFICATION_BROKER') or 'redis'
+    NOTIFICATION_STREAM_TIMEOUT = float(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+    NOTIFICATION_STREAM_KEEPALIVE = float(os.environ.get('NOTIFICATION_STREAM_KEEPALIVE') or 15)
+    # how long to keep using in-process fallbacks after a Redis call has failed
+    REDIS_RETRY_SECONDS = int(os.environ.get('REDIS_RETRY_SECONDS') or 30)
+    # the maximum number of post ids kept in each user's precomputed home timeline
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    # the number of most recent posts kept in the timeline shared by all users, which serves the explore page
+    EXPLORE_TIMELINE_LENGTH = int(os.environ.get('EXPLORE_TIMELINE_LENGTH') or 1000)
+    # last_seen times are buffered and written to the database in bulk every LAST_SEEN_FLUSH_INTERVAL seconds, and are
+    # only recorded when the previous one is at least LAST_SEEN_GRANULARITY seconds older
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_CACHE_SIZE = int(os.environ.get('LAST_SEEN_CACHE_SIZE') or 10000)
+    # every COMPACTION_INTERVAL seconds, a background job deletes the tasks completed more than TASK_RETENTION_DAYS ago
+    # and the notifications not updated for NOTIFICATION_RETENTION_DAYS, COMPACTION_BATCH_SIZE rows per transaction
+    COMPACTION_INTERVAL = int(os.environ.get('COMPACTION_INTERVAL') or 3600)
+    COMPACTION_BATCH_SIZE = int(os.environ.get('COMPACTION_BATCH_SIZE') or 1000)
+    TASK_RETENTION_DAYS = float(os.environ.get('TASK_RETENTION_DAYS') or 7)
+    NOTIFICATION_RETENTION_DAYS = float(os.environ.get('NOTIFICATION_RETENTION_DAYS') or 30)
+    # the version stamps behind ETags are kept in Redis ('redis') or, within a single process, in memory ('local'), and
+    # kept in Redis for ETAG_STAMP_TTL seconds without changes
+    ETAG_STAMPS = os.environ.get('ETAG_STAMPS') or 'redis'
+    ETAG_STAMP_TTL = int(os.environ.get('ETAG_STAMP_TTL') or 86400)
+    # rendered post fragments are cached in each worker, and shared through Redis
+    POST_FRAGMENT_CACHE_SIZE = int(os.environ.get('POST_FRAGMENT_CACHE_SIZE') or 5000)
+    POST_FRAGMENT_CACHE_TTL = int(os.environ.get('POST_FRAGMENT_CACHE_TTL') or 600)
+    POST_FRAGMENT_REDIS_TTL = int(os.environ.get('POST_FRAGMENT_REDIS_TTL') or 86400)
+    # the parts of user popups shared by all viewers are cached likewise
+    POPUP_FRAGMENT_CACHE_SIZE = int(os.environ.get('POPUP_FRAGMENT_CACHE_SIZE') or 1000)
+    POPUP_FRAGMENT_CACHE_TTL = int(os.environ.get('POPUP_FRAGMENT_CACHE_TTL') or 600)
+    POPUP_FRAGMENT_REDIS_TTL = int(os.environ.get('POPUP_FRAGMENT_REDIS_TTL') or 600)
+    # the per-worker cache of the users loaded by Flask-Login, invalidated across workers over Redis pub/sub
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+    # how long browsers may reuse the popup of a user
+    USER_POPUP_MAX_AGE = int(os.environ.get('USER_POPUP_MAX_AGE') or 60)
+    # accounts with at least this many followers have their posts pulled into home timelines at read time, instead of
+    # pushed to every follower, until they fall below FEED_PULL_DEMOTE_THRESHOLD followers; the set of these accounts is
+    # cached in each worker for FEED_PULL_SOURCES_TTL seconds
+    FEED_PULL_THRESHOLD = int(os.environ.get('FEED_PULL_THRESHOLD') or 10000)
+    FEED_PULL_DEMOTE_THRESHOLD = int(os.environ.get('FEED_PULL_DEMOTE_THRESHOLD') or 8000)
+    FEED_PULL_SOURCES_TTL = int(os.environ.get('FEED_PULL_SOURCES_TTL') or 60)
+    # the per-worker LRU cache of who each user follows, in front of the per-user sets kept in Redis
+    FOLLOW_GRAPH_CACHE_SIZE = int(os.environ.get('FOLLOW_GRAPH_CACHE_SIZE') or 10000)
+    FOLLOW_GRAPH_CACHE_TTL = int(os.environ.get('FOLLOW_GRAPH_CACHE_TTL') or 10)
+    FOLLOW_GRAPH_REDIS_TTL = int(os.environ.get('FOLLOW_GRAPH_REDIS_TTL') or 3600)
 
 
 class TestConfig(Config):
@@ -32,4 +123,8 @@ class TestConfig(Config):
 
     TESTING = True 
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    NOTIFICATION_BROKER = 'local'
+    ETAG_STAMPS = 'local'
+    SEARCH_BACKEND = 'memory'
+    TRANSLATION_CACHE_DATABASE = ':memory:'
     
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""Added a primary key and indexes to followers, and composite indexes to posts and messages
+
+Revision ID: 5d2c7e1f9a43
+Revises: 910fec74d870
+Create Date: 2026-10-16 09:12:41.305518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c7e1f9a43'
+down_revision = '910fec74d870'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop incomplete and duplicate follow rows, which would violate the new primary key
+    conn = op.get_bind()
+    rows = conn.execute(sa.text(
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')).fetchall()
+    op.execute('DELETE FROM followers')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    followers = sa.table('followers', sa.column('follower_id', sa.Integer), sa.column('followed_id', sa.Integer))
+    if rows:
+        op.bulk_insert(followers, [{'follower_id': row[0], 'followed_id': row[1]} for row in rows])
+
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_message_recipient_id_timestamp', 'message', ['recipient_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
@@ -0,0 +1,34 @@
+"""Added an unread message counter to the User model
+
+Revision ID: a7c4e2f9b316
+Revises: f1d3b6a8e924
+Create Date: 2026-10-17 11:26:53.840192
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c4e2f9b316'
+down_revision = 'f1d3b6a8e924'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('unread_message_count', sa.Integer(), server_default='0', nullable=False))
+
+    # fill in the counters of existing users
+    user = sa.table('user', sa.column('id', sa.Integer()), sa.column('last_message_read_time', sa.DateTime()),
+                    sa.column('unread_message_count', sa.Integer()))
+    message = sa.table('message', sa.column('recipient_id', sa.Integer()), sa.column('timestamp', sa.DateTime()))
+    unread = sa.select([sa.func.count()]).where(sa.and_(
+        message.c.recipient_id == user.c.id,
+        message.c.timestamp > sa.func.coalesce(user.c.last_message_read_time, datetime(1900, 1, 1))))
+    op.execute(user.update().values(unread_message_count=unread.scalar_subquery()))
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_message_count')
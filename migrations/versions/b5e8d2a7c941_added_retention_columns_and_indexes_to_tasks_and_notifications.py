@@ -0,0 +1,36 @@
+"""Added a completion time and indexes to the Task model, and an index on the timestamp of notifications
+
+Revision ID: b5e8d2a7c941
+Revises: a7c4e2f9b316
+Create Date: 2026-10-17 14:08:12.316420
+
+"""
+from time import time
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e8d2a7c941'
+down_revision = 'a7c4e2f9b316'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('task', sa.Column('completed_at', sa.Float(), nullable=True))
+    op.create_index(op.f('ix_task_completed_at'), 'task', ['completed_at'], unique=False)
+    op.create_index('ix_task_user_id_complete', 'task', ['user_id', 'complete'], unique=False)
+    op.create_index('ix_notification_timestamp', 'notification', ['timestamp'], unique=False)
+
+    # the tasks completed so far start their retention period now
+    task = sa.table('task', sa.column('complete', sa.Boolean()), sa.column('completed_at', sa.Float()))
+    op.execute(task.update().where(task.c.complete == sa.true()).values(completed_at=time()))
+
+
+def downgrade():
+    op.drop_index('ix_notification_timestamp', table_name='notification')
+    op.drop_index('ix_task_user_id_complete', table_name='task')
+    op.drop_index(op.f('ix_task_completed_at'), table_name='task')
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_column('completed_at')
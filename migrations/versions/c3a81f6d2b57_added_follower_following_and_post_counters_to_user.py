@@ -0,0 +1,38 @@
+"""Added follower, following and post counters to the User model
+
+Revision ID: c3a81f6d2b57
+Revises: 5d2c7e1f9a43
+Create Date: 2026-10-16 14:37:02.918264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a81f6d2b57'
+down_revision = '5d2c7e1f9a43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+
+    # fill in the counters of existing users
+    user = sa.table('user', sa.column('id', sa.Integer()), sa.column('followers_count', sa.Integer()),
+                    sa.column('followed_count', sa.Integer()), sa.column('posts_count', sa.Integer()))
+    followers = sa.table('followers', sa.column('follower_id', sa.Integer()), sa.column('followed_id', sa.Integer()))
+    post = sa.table('post', sa.column('user_id', sa.Integer()))
+    op.execute(user.update().values(
+        followers_count=sa.select([sa.func.count()]).where(followers.c.followed_id == user.c.id).scalar_subquery(),
+        followed_count=sa.select([sa.func.count()]).where(followers.c.follower_id == user.c.id).scalar_subquery(),
+        posts_count=sa.select([sa.func.count()]).where(post.c.user_id == user.c.id).scalar_subquery()))
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('posts_count')
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('followers_count')
@@ -0,0 +1,33 @@
+"""Added a search outbox table
+
+Revision ID: c9f2a4e6b813
+Revises: b5e8d2a7c941
+Create Date: 2026-10-17 16:42:05.127391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9f2a4e6b813'
+down_revision = 'b5e8d2a7c941'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('index_name', sa.String(length=64), nullable=True),
+    sa.Column('object_id', sa.Integer(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('next_attempt', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_search_outbox_next_attempt'), 'search_outbox', ['next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_search_outbox_next_attempt'), table_name='search_outbox')
+    op.drop_table('search_outbox')
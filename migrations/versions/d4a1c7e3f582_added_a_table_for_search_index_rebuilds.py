@@ -0,0 +1,29 @@
+"""Added a table for the search index rebuilds in progress
+
+Revision ID: d4a1c7e3f582
+Revises: c9f2a4e6b813
+Create Date: 2026-10-17 19:13:47.904216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a1c7e3f582'
+down_revision = 'c9f2a4e6b813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_reindex',
+    sa.Column('index_name', sa.String(length=64), nullable=False),
+    sa.Column('target', sa.String(length=128), nullable=True),
+    sa.Column('last_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('index_name')
+    )
+
+
+def downgrade():
+    op.drop_table('search_reindex')
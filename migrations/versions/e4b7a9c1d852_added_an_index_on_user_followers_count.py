@@ -0,0 +1,23 @@
+"""Added an index on the followers_count column of the User model
+
+Revision ID: e4b7a9c1d852
+Revises: c3a81f6d2b57
+Create Date: 2026-10-16 16:02:41.551370
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7a9c1d852'
+down_revision = 'c3a81f6d2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_user_followers_count'), 'user', ['followers_count'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_followers_count'), table_name='user')
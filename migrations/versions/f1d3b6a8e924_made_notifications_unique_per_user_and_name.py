@@ -0,0 +1,35 @@
+"""Made notifications unique per user and name, and indexed them by user and timestamp
+
+Revision ID: f1d3b6a8e924
+Revises: e4b7a9c1d852
+Create Date: 2026-10-17 09:41:17.203845
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1d3b6a8e924'
+down_revision = 'e4b7a9c1d852'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the latest notification of each name for each user, which would violate the new unique constraint
+    op.execute('DELETE FROM notification WHERE id NOT IN '
+               '(SELECT id FROM (SELECT max(id) AS id FROM notification GROUP BY user_id, name) AS latest)')
+
+    op.drop_index('ix_notification_timestamp', table_name='notification')
+    op.drop_index('ix_notification_name', table_name='notification')
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_notification_user_id_name', ['user_id', 'name'])
+    op.create_index('ix_notification_user_id_timestamp', 'notification', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_notification_user_id_name', type_='unique')
+    op.create_index('ix_notification_name', 'notification', ['name'], unique=False)
+    op.create_index('ix_notification_timestamp', 'notification', ['timestamp'], unique=False)
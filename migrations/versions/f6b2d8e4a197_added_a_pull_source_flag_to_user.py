@@ -0,0 +1,33 @@
+"""Added a pull source flag to the User model
+
+Revision ID: f6b2d8e4a197
+Revises: d4a1c7e3f582
+Create Date: 2026-10-18 10:41:22.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b2d8e4a197'
+down_revision = 'd4a1c7e3f582'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('pull_source', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.create_index(op.f('ix_user_pull_source'), 'user', ['pull_source'], unique=False)
+
+    # flag the users who were pull sources by their number of followers, at the default FEED_PULL_THRESHOLD, so that
+    # the migration does not depend on the configuration it runs with; flags follow the configured thresholds from
+    # then on, as follows and unfollows go through User.update_pull_source()
+    user = sa.table('user', sa.column('pull_source', sa.Boolean()), sa.column('followers_count', sa.Integer()))
+    op.execute(user.update().where(user.c.followers_count >= 10000).values(pull_source=True))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_pull_source'), table_name='user')
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('pull_source')
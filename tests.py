@@ -1,7 +1,24 @@
 from datetime import datetime, timedelta
+import json
+from time import time
+import re
+import tempfile
 import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from unittest import mock
+from elasticsearch.exceptions import ConnectionError as ElasticsearchConnectionError
 from app import create_app, db
-from app.models import User, Post 
+from app.models import User, Post, Message, Notification, Task, SearchOutbox, SearchReindex, followers, load_user
+from app.broker import RedisBroker
+from app.maintenance import compact
+from app.last_seen import record_last_seen, flush_last_seen
+from app.search import FTSIndex, fts_database, make_search_index
+from app.suggest import suggest, PrefixIndex
+from app.translate import translation_metrics
+from app.user_cache import invalidate_users
+from app.pagination import decode_cursor, decode_search_cursor, keyset_query, keyset_paginate
+from app.timeline import timestamp_score
 from config import TestConfig
 
 
@@ -49,6 +66,89 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_graph_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.is_following_many([u2.id, u3.id]), {u2.id: True, u3.id: False})
+
+        # pending changes are seen before commit, and the cache is invalidated by the commit
+        u1.follow(u3)
+        self.assertTrue(u1.is_following(u3))
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.is_following_many([u2.id, u3.id]), {u2.id: True, u3.id: True})
+        self.assertEqual(u1.followed_count, 2)
+
+        # changes through the followers backref invalidate the cache too, and rollbacks leave it untouched
+        u3.followers.remove(u1)
+        self.assertFalse(u1.is_following(u3))
+        db.session.rollback()
+        self.assertTrue(u1.is_following(u3))
+        u3.followers.remove(u1)
+        db.session.commit()
+        self.assertFalse(u1.is_following(u3))
+
+        # follows and unfollows check the followers table, which the cache may lag behind
+        db.session.execute(followers.insert().values(follower_id=u1.id, followed_id=u3.id))
+        db.session.commit()
+        self.assertFalse(u1.is_following(u3))
+        followed_count = u1.followed_count
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual((u1.followed.count(), u1.followed_count), (2, followed_count))
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual((u1.followed.count(), u1.followed_count), (1, followed_count - 1))
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        p1 = Post(body='post from susan', author=u2)
+        p2 = Post(body='another post from susan', author=u2)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.followed_count, u1.posts_count), (0, 1, 0))
+        self.assertEqual((u2.followers_count, u2.followed_count, u2.posts_count), (1, 0, 2))
+        u1.unfollow(u2)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.followed_count, u1.posts_count), (0, 0, 0))
+        self.assertEqual((u2.followers_count, u2.followed_count, u2.posts_count), (0, 0, 1))
+
+        # drifted counters get fixed by a reconciliation
+        u1.followers_count = 5
+        u2.posts_count = 0
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(), 2)
+        self.assertEqual((u1.followers_count, u2.posts_count), (0, 1))
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_unread_message_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add_all([Message(author=u1, recipient=u2, body='hi'), Message(author=u1, recipient=u2, body='hey')])
+        db.session.commit()
+        self.assertEqual((u1.new_messages(), u2.new_messages()), (0, 2))
+
+        # the counter is recomputed from the messages received since they were last read
+        u2.last_message_read_time = datetime.utcnow()
+        db.session.add(Message(author=u1, recipient=u2, body='hello again',
+                               timestamp=(datetime.utcnow() + timedelta(seconds=1))))
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 3)
+        self.assertEqual(User.reconcile_counters(), 1)
+        self.assertEqual(u2.new_messages(), 1)
+
     def test_follow_posts(self):
         # create 4 users
         u1 = User(username='john', email='john@example.com')
@@ -59,10 +159,10 @@ class UserModelCase(unittest.TestCase):
 
         # create 4 posts
         now = datetime.utcnow()
-        p1 = Post(body='post from john', author=u1, datetime=(now + timedelta(seconds=1)))
-        p2 = Post(body='post from susan', author=u2, datetime=(now + timedelta(seconds=4)))
-        p3 = Post(body='post from mary', author=u3, datetime=(now + timedelta(seconds=3)))
-        p4 = Post(body="post from david", author=u4, datetime=(now + timedelta(seconds=2)))
+        p1 = Post(body='post from john', author=u1, timestamp=(now + timedelta(seconds=1)))
+        p2 = Post(body='post from susan', author=u2, timestamp=(now + timedelta(seconds=4)))
+        p3 = Post(body='post from mary', author=u3, timestamp=(now + timedelta(seconds=3)))
+        p4 = Post(body="post from david", author=u4, timestamp=(now + timedelta(seconds=2)))
         db.session.add_all([p1, p2, p3, p4])
         db.session.commit()
 
@@ -83,6 +183,778 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        # create 3 users and 5 posts
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        now = datetime.utcnow()
+        p1 = Post(body='post from john', author=u1, timestamp=(now + timedelta(seconds=1)))
+        p2 = Post(body='post from susan', author=u2, timestamp=(now + timedelta(seconds=2)))
+        p3 = Post(body='post from mary', author=u3, timestamp=(now + timedelta(seconds=3)))
+        p4 = Post(body='another post from susan', author=u2, timestamp=(now + timedelta(seconds=4)))
+        db.session.add_all([p1, p2, p3, p4])
+        u1.follow(u2)
+        db.session.commit()
+
+        # the timeline is built on first read, and then serves pages from the cache
+        page = u1.timeline(2)
+        self.assertEqual(page.items, [p4, p2])
+        self.assertTrue(page.has_next)
+        self.assertFalse(page.has_prev)
+        page = u1.timeline(2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [p1])
+        self.assertFalse(page.has_next)
+        page = u1.timeline(2, before=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, [p4, p2])
+        self.assertFalse(page.has_prev)
+
+        # new posts get pushed into the timelines of followers
+        p5 = Post(body='new post from susan', author=u2, timestamp=(now + timedelta(seconds=5)))
+        db.session.add(p5)
+        db.session.commit()
+        self.assertEqual(u1.timeline(5).items, [p5, p4, p2, p1])
+
+        # with a task queue, the push to followers is left to a job
+        with mock.patch('app.models.get_redis', return_value=self.app.redis), \
+                mock.patch.object(self.app, 'task_queue') as task_queue:
+            p6 = Post(body='queued post from susan', author=u2, timestamp=(now + timedelta(seconds=6)))
+            db.session.add(p6)
+            db.session.commit()
+        jobs = [call[0][1:] for call in task_queue.enqueue.call_args_list if call[0][0] == 'app.tasks.fan_out_post']
+        self.assertEqual(jobs, [(p6.id, u2.id, timestamp_score(p6.timestamp))])
+        self.assertEqual(u1.timeline(5).items, [p5, p4, p2, p1])
+        Post.fan_out(*jobs[0])
+        self.assertEqual(u1.timeline(5).items, [p6, p5, p4, p2, p1])
+        db.session.delete(p6)
+        db.session.commit()
+
+        # follows and unfollows are reflected in the timeline
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.timeline(5).items, [p5, p4, p3, p2, p1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline(5).items, [p3, p1])
+
+        # page numbers from old links still work
+        self.assertEqual(u1.timeline(1, page=2).items, [p1])
+
+    def test_timeline_overflow(self):
+        # posts older than a trimmed timeline are read from the database
+        self.app.config['TIMELINE_LENGTH'] = 2
+        u1 = User(username='john', email='john@example.com')
+        db.session.add(u1)
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u1, timestamp=(now + timedelta(seconds=i))) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        page = u1.timeline(2)
+        self.assertEqual(page.items, [posts[4], posts[3]])
+        page = u1.timeline(2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        page = u1.timeline(2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[0]])
+        self.assertFalse(page.has_next)
+        page = u1.timeline(2, before=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        p = Post(body='post 5', author=u1, timestamp=(now + timedelta(seconds=5)))
+        db.session.add(p)
+        db.session.commit()
+        page = u1.timeline(3)
+        self.assertEqual(page.items, [p, posts[4], posts[3]])
+        self.assertEqual(u1.timeline(3, after=decode_cursor(page.next_cursor)).items, [posts[2], posts[1], posts[0]])
+
+    def test_timeline_pull_sources(self):
+        # the posts of users with many followers are merged into the timeline at read time
+        self.app.config['FEED_PULL_THRESHOLD'] = 2
+        self.app.config['FEED_PULL_DEMOTE_THRESHOLD'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline(3).items, [])
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=(u3 if i % 2 else u2), timestamp=(now + timedelta(seconds=i)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(u1.pushed_posts(5), [posts[4], posts[2], posts[0]])
+        page = u1.timeline(3)
+        self.assertEqual(page.items, [posts[4], posts[3], posts[2]])
+        page = u1.timeline(3, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[1], posts[0]])
+        self.assertFalse(page.has_next)
+        page = u1.timeline(3, before=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, [posts[4], posts[3], posts[2]])
+        self.assertFalse(page.has_prev)
+
+        # pull sources stay so until they fall below the demotion threshold, and then have their posts pushed
+        self.app.config['FEED_PULL_DEMOTE_THRESHOLD'] = 1
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertTrue(u3.pull_source)
+        u2.follow(u3)
+        db.session.commit()
+        self.app.config['FEED_PULL_DEMOTE_THRESHOLD'] = 2
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertFalse(u3.pull_source)
+        self.assertEqual(u1.pushed_posts(5), posts[::-1])
+        self.assertEqual(u1.timeline(5).items, posts[::-1])
+
+    def test_explore(self):
+        # pages past the end of the global timeline are read from the database
+        self.app.config['EXPLORE_TIMELINE_LENGTH'] = 3
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=(u1 if i % 2 else u2), timestamp=(now + timedelta(seconds=i)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        page = Post.explore(2)
+        self.assertEqual(page.items, [posts[4], posts[3]])
+        page = Post.explore(2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        page = Post.explore(2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[0]])
+        self.assertFalse(page.has_next)
+        page = Post.explore(2, before=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        p = Post(body='post 5', author=u1, timestamp=(now + timedelta(seconds=5)))
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(Post.explore(2).items, [p, posts[4]])
+        db.session.delete(posts[4])
+        db.session.commit()
+        self.assertEqual(Post.explore(2).items, [p, posts[3]])
+        self.assertEqual(Post.explore(2, page=2).items, [posts[2], posts[1]])
+
+    def test_last_seen(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow() + timedelta(minutes=5)
+        self.assertFalse(record_last_seen(u1.id, u1.last_seen + timedelta(seconds=10), u1.last_seen))
+        self.assertTrue(record_last_seen(u1.id, now, u1.last_seen))
+        # within the granularity of the previous time
+        self.assertFalse(record_last_seen(u1.id, now + timedelta(seconds=10), u1.last_seen))
+        self.assertTrue(record_last_seen(u1.id, now + timedelta(minutes=2), u1.last_seen))
+        self.assertTrue(record_last_seen(u2.id, now, u2.last_seen))
+        self.assertEqual(flush_last_seen(), 2)
+        self.assertEqual(u1.last_seen, now + timedelta(minutes=2))
+        self.assertEqual(u2.last_seen, now)
+        self.assertEqual(flush_last_seen(), 0)
+
+    def test_user_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = str(u.id)
+        db.session.remove()
+        self.assertEqual(load_user(user_id).username, 'john')
+
+        # the user is rebuilt from its snapshot without a query
+        db.session.remove()
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        u = load_user(user_id)
+        self.assertEqual((u.username, u.email), ('john', 'john@example.com'))
+        self.assertEqual(statements, [])
+        self.assertEqual(u.posts_count, 0)
+        self.assertEqual(len(statements), 1)
+
+        # profile changes invalidate the snapshot
+        u.about_me = 'hello'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(user_id).about_me, 'hello')
+
+    def test_user_cache_invalidated_during_fill(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        # the user is invalidated, as by another worker, while its snapshot is being loaded
+        def invalidate(*args):
+            invalidate_users([user_id])
+
+        db.event.listen(db.engine, 'before_cursor_execute', invalidate)
+        self.assertEqual(load_user(str(user_id)).username, 'john')
+        db.event.remove(db.engine, 'before_cursor_execute', invalidate)
+        self.assertIsNone(self.app.local_stores['users'].get(user_id))
+
+        # the next load caches the snapshot
+        db.session.remove()
+        load_user(str(user_id))
+        self.assertIsNotNone(self.app.local_stores['users'].get(user_id))
+
+    def test_add_notification(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 1)
+        u.add_notification('task_progress', {'task_id': 'abc', 'progress': 50})
+        db.session.commit()
+        # notifications of the same name are updated in place
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(sorted((n.name, n.get_data()) for n in u.notifications),
+                         [('task_progress', {'task_id': 'abc', 'progress': 50}), ('unread_message_count', 2)])
+
+    def test_compact(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        old = time() - 60 * 86400
+        db.session.add_all([Task(id='done-long-ago', user=u, complete=True, completed_at=old),
+                            Task(id='done-recently', user=u, complete=True, completed_at=time()),
+                            Task(id='in-progress', user=u, complete=False)])
+        u.add_notification('task_progress', {'progress': 100})
+        u.add_notification('unread_message_count', 0)
+        db.session.commit()
+        Notification.query.filter_by(name='task_progress').update({'timestamp': old})
+        db.session.commit()
+
+        self.app.config['COMPACTION_BATCH_SIZE'] = 1
+        report = compact()
+        self.assertEqual((report['tasks'], report['notifications']), (1, 1))
+        self.assertEqual(sorted(task.id for task in Task.query), ['done-recently', 'in-progress'])
+        self.assertEqual([n.name for n in u.notifications], ['unread_message_count'])
+        self.assertEqual((compact()['tasks'], compact()['notifications']), (0, 0))
+
+    def search(self, expression, per_page, **kwargs):
+        """This method searches posts, and returns the posts found and the total number of hits."""
+
+        page = Post.search(expression, per_page, **kwargs)
+        return page.items, page.total
+
+    def test_search_outbox(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy dog', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        SearchOutbox.drain()
+        self.assertEqual(self.search('fox', 10), ([p1], 1))
+        self.assertEqual(SearchOutbox.query.count(), 0)
+
+        # changes that fail to reach the index stay in the outbox, and are retried with backoff
+        with mock.patch.object(self.app.search_index, 'bulk', side_effect=ElasticsearchConnectionError('N/A', 'down', OSError('down'))):
+            p2.body = 'a quick dog'
+            db.session.commit()
+            self.assertEqual(SearchOutbox.drain(), (0, self.app.config['SEARCH_OUTBOX_RETRY_SECONDS']))
+        self.assertEqual(SearchOutbox.query.one().attempts, 1)
+        self.assertEqual(SearchOutbox.drain()[0], 0)
+        SearchOutbox.query.update({'next_attempt': 0})
+        self.assertEqual(SearchOutbox.drain(), (1, None))
+        self.assertEqual(self.search('quick', 10)[1], 2)
+
+        # changes to fields that are not searchable are left out, deletions are applied
+        u.about_me = 'hi'
+        p1.language = 'en'
+        db.session.delete(p2)
+        db.session.flush()
+        self.assertEqual(SearchOutbox.query.count(), 1)
+        db.session.commit()
+        SearchOutbox.drain()
+        self.assertEqual(self.search('quick', 10), ([p1], 1))
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body='post {}'.format(i), author=u) for i in range(7)])
+        db.session.commit()
+        SearchOutbox.drain()
+        index = self.app.search_index
+        index.indexes['post'].clear()
+
+        # an interrupted rebuild leaves the index in use alone, and resumes from its checkpoint
+        bulk = index.bulk
+        calls = []
+
+        def fail_third_call(body, **kwargs):
+            calls.append(body)
+            if len(calls) == 3:
+                raise ElasticsearchConnectionError('N/A', 'down', OSError('down'))
+            return bulk(body, **kwargs)
+
+        with mock.patch.object(index, 'bulk', side_effect=fail_third_call):
+            with self.assertRaises(ElasticsearchConnectionError):
+                Post.reindex(1, 2)
+        self.assertEqual(SearchReindex.query.get('post').last_id, 4)
+        self.assertEqual(self.search('post', 10)[1], 0)
+
+        # changes made during the rebuild reach the new index too
+        db.session.add(Post(body='another post', author=u))
+        db.session.commit()
+        SearchOutbox.drain()
+        progress = []
+        self.assertEqual(Post.reindex(2, 2, progress=lambda indexed, total: progress.append(indexed)), 4)
+        self.assertEqual(progress, [2, 4])
+        self.assertIsNone(SearchReindex.query.get('post'))
+        self.assertEqual(self.search('post', 10)[1], 8)
+        self.assertEqual(list(index.aliases), ['post'])
+        self.assertEqual(len(index.indexes), 1)
+
+    def test_search_cache(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        db.session.add_all([u, p1])
+        db.session.commit()
+        SearchOutbox.drain()
+        index = self.app.search_index
+        with mock.patch.object(index, 'search', wraps=index.search) as search:
+            self.assertEqual(self.search('Quick  fox', 10), ([p1], 1))
+            self.assertEqual(self.search('quick fox', 10), ([p1], 1))
+            self.assertEqual(self.search('quick fox', 10, page=2), ([], 1))
+            self.assertEqual(search.call_count, 2)
+
+            # writing to the index retires the cached results
+            p2 = Post(body='a quick dog', author=u)
+            db.session.add(p2)
+            db.session.commit()
+            SearchOutbox.drain()
+            self.assertEqual(self.search('quick fox', 10), ([p1, p2], 2))
+            self.assertEqual(search.call_count, 3)
+
+    def test_search_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body='fox ' * (i % 3 + 1), author=u) for i in range(8)])
+        db.session.commit()
+        for index in self.app.search_index, FTSIndex(':memory:'):
+            self.app.search_index = index
+            Post.reindex(1, 10)
+            ranked = Post.search('fox', 8).items
+
+            # pages follow each other through the cursors, both ways
+            pages = [Post.search('fox', 3)]
+            while pages[-1].has_next:
+                pages.append(Post.search('fox', 3, after=decode_search_cursor(pages[-1].next_cursor)))
+            self.assertEqual([post for page in pages for post in page.items], ranked)
+            self.assertEqual(len(pages), 3)
+            self.assertEqual(pages[1].total, 8)
+            previous = Post.search('fox', 3, before=decode_search_cursor(pages[2].prev_cursor))
+            self.assertEqual(previous.items, pages[1].items)
+            self.assertTrue(previous.has_prev and previous.has_next)
+            self.assertFalse(Post.search('fox', 3, before=decode_search_cursor(pages[1].prev_cursor)).has_prev)
+            self.assertEqual(Post.search('fox', 3, page=2).items, pages[1].items)
+
+    def test_prefix_index(self):
+        index = PrefixIndex({'fox': 3, 'Foxtrot': 1, 'fold': 1, 'dog': 2})
+        self.assertEqual(index.complete('FO', 10), ['fox', 'fold', 'Foxtrot'])
+        self.assertEqual(index.complete('fo', 1), ['fox'])
+        self.assertEqual(index.complete('x', 10), [])
+        index.add('fox', -3)
+        index.add('folk')
+        index.discard('Foxtrot')
+        index.add('cat', -1)
+        self.assertEqual(index.complete('f', 10), ['fold', 'folk'])
+        self.assertEqual(len(index), 3)
+
+    def test_suggest(self):
+        self.app.config['SUGGEST_SYNC_SECONDS'] = 0
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='Johanna', email='johanna@example.com')
+        db.session.add_all([u1, u2, Post(body='The fox jumps over foxes', author=u1),
+                            Post(body='a fox', author=u2)])
+        db.session.commit()
+        self.assertEqual(suggest('jo', 5), {'users': ['Johanna', 'john'], 'terms': []})
+        self.assertEqual(suggest('ju', 5), {'users': [], 'terms': ['jumps']})
+        self.assertEqual(suggest('the FO', 5), {'users': [], 'terms': ['fox', 'foxes']})
+        self.assertEqual(suggest(' ', 5), {'users': [], 'terms': []})
+
+        # the prefix indexes follow the changes
+        p = Post(body='foxtrot foxtrot', author=u1)
+        u2.username = 'susan'
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(suggest('fox', 5)['terms'], ['fox', 'foxes', 'foxtrot'])
+        self.assertEqual(suggest('jo', 5)['users'], ['john'])
+        self.assertEqual(suggest('su', 5)['users'], ['susan'])
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(suggest('foxt', 5)['terms'], [])
+
+    def test_fts_index(self):
+        # the FTS5 tables go to the app database when it is SQLite, which every process shares
+        config = {'SEARCH_FTS_DATABASE': None, 'SQLALCHEMY_DATABASE_URI': 'sqlite:////srv/app.db'}
+        self.assertEqual(fts_database(config), '/srv/app.db')
+        with self.assertRaises(RuntimeError):
+            fts_database(dict(config, SQLALCHEMY_DATABASE_URI='mysql+pymysql://microblog@db/microblog'))
+        self.assertEqual(fts_database(dict(config, SEARCH_FTS_DATABASE='/shared/search.db')), '/shared/search.db')
+
+        # only a database of its own is switched to WAL, the journal mode of the app database is left alone
+        with tempfile.TemporaryDirectory() as directory:
+            config = dict(config, SEARCH_BACKEND='fts', SQLALCHEMY_DATABASE_URI='sqlite:///' + directory + '/app.db')
+            index = make_search_index(config)
+            self.assertEqual(index.connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            index.connection.close()
+            index = make_search_index(dict(config, SEARCH_FTS_DATABASE=directory + '/search.db'))
+            self.assertEqual(index.connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            index.connection.close()
+
+        self.app.search_index = FTSIndex(':memory:')
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='the quick brown fox', author=u), Post(body='a lazy dog', author=u),
+                 Post(body='quick quick quick', author=u), Post(body='the dog and the fox', author=u)]
+        db.session.add_all(posts)
+        db.session.commit()
+        SearchOutbox.drain()
+
+        # hits are ranked, and paginated
+        self.assertEqual(self.search('quick', 10), ([posts[2], posts[0]], 2))
+        self.assertEqual(self.search('fox dog', 1), ([posts[3]], 3))
+        self.assertEqual(self.search('fox dog', 2, page=2)[0], [posts[0]])
+        self.assertEqual(self.search('"', 10), ([], 0))
+
+        # the index is kept in sync with changes and deletions, and can be rebuilt
+        posts[1].body = 'a lazy cat'
+        db.session.delete(posts[3])
+        db.session.commit()
+        SearchOutbox.drain()
+        self.assertEqual(self.search('dog', 10), ([], 0))
+        self.assertEqual(Post.reindex(2, 2), 3)
+        self.assertEqual(self.search('cat fox', 10)[1], 2)
+        self.assertTrue(self.app.search_index.indices.exists_alias(name='post'))
+
+    def test_keyset_paginate(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.utcnow()
+        # two posts share a timestamp, so they are told apart by their ids
+        posts = [Post(body='post {}'.format(i), author=u, timestamp=(now + timedelta(seconds=min(i, 3))))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        page = keyset_paginate(Post.query, Post, 2)
+        self.assertEqual(page.items, [posts[4], posts[3]])
+        self.assertFalse(page.has_prev)
+        page = keyset_paginate(Post.query, Post, 2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        page = keyset_paginate(Post.query, Post, 2, after=decode_cursor(page.next_cursor))
+        self.assertEqual(page.items, [posts[0]])
+        self.assertFalse(page.has_next)
+        page = keyset_paginate(Post.query, Post, 2, before=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        self.assertTrue(page.has_prev)
+        self.assertEqual(keyset_paginate(u.posts, Post, 2, page=2).items, [posts[2], posts[1]])
+        self.assertIsNone(decode_cursor('not a cursor'))
+
+
+
+class QueryPlanCase(unittest.TestCase):
+    """This class implements a child class of unittest.TestCase to check that the hot queries are served by indexes."""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def query_plan(self, query):
+        """This method returns the SQLite query plan of a query as a single string."""
+
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        params = tuple(statement.params[name] for name in statement.positiontup)
+        rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + str(statement), params)
+        return ' | '.join(row[-1] for row in rows)
+
+    def assertUsesIndex(self, query, index):
+        plan = self.query_plan(query)
+        self.assertIn('USING', plan)
+        self.assertIn(index, plan)
+        self.assertNotRegex(plan, r'SCAN (TABLE )?(followers|post|message)( |$)')
+
+    def test_is_following(self):
+        self.assertUsesIndex(self.u1.followed.filter(followers.c.followed_id == self.u2.id),
+                             'sqlite_autoindex_followers_1')
+
+    def test_follow_counts(self):
+        self.assertUsesIndex(self.u1.followed, 'sqlite_autoindex_followers_1')
+        self.assertUsesIndex(self.u1.followers, 'ix_followers_followed_id_follower_id')
+
+    def test_followed_posts(self):
+        plan = self.query_plan(self.u1.followed_posts())
+        self.assertIn('sqlite_autoindex_followers_1', plan)
+        self.assertIn('ix_post_user_id_timestamp', plan)
+
+    def test_user_posts(self):
+        self.assertUsesIndex(keyset_query(self.u1.posts, Post), 'ix_post_user_id_timestamp')
+
+    def test_messages_received(self):
+        self.assertUsesIndex(keyset_query(self.u1.messages_received, Message), 'ix_message_recipient_id_timestamp')
+
+    def test_tasks_in_progress(self):
+        self.assertUsesIndex(Task.query.filter_by(user=self.u1, complete=False), 'ix_task_user_id_complete')
+
+    def test_compaction(self):
+        self.assertUsesIndex(Task.query.filter(Task.completed_at < 1.0), 'ix_task_completed_at')
+        self.assertUsesIndex(Notification.query.filter(Notification.timestamp < 1.0), 'ix_notification_timestamp')
+
+    def test_notifications_since(self):
+        self.assertUsesIndex(self.u1.notifications.filter(Notification.timestamp > 1.0).order_by(
+            Notification.timestamp.asc()), 'ix_notification_user_id_timestamp')
+
+
+
+class PageQueriesCase(unittest.TestCase):
+    """This class implements a child class of unittest.TestCase to check the number of queries issued by list views."""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        # create 6 users with one post each, and a user who follows them all
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(6)]
+        viewer = User(username='viewer', email='viewer@example.com')
+        viewer.set_password('cat')
+        db.session.add_all(users + [viewer])
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post from {}'.format(u.username), author=u,
+                                 timestamp=(now + timedelta(seconds=i))) for i, u in enumerate(users)])
+        for u in users:
+            viewer.follow(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'viewer', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_queries(self, url):
+        """This method returns the number of SQL statements issued while serving a GET request to the given URL."""
+
+        # start from a fresh session, as every request does outside of tests
+        db.session.remove()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return int(re.search(r'desc="(\d+) queries"', response.headers['Server-Timing']).group(1))
+
+    def test_slow_query_log(self):
+        self.app.config['SQL_SLOW_QUERY_MS'] = 0
+        with self.assertLogs('microblog.slow_queries', level='WARNING') as logs:
+            self.client.get('/explore')
+        self.assertTrue(any('[main.explore] SELECT' in line for line in logs.output))
+        # parameter lists are elided
+        self.assertTrue(any('IN (...)' in line for line in logs.output))
+
+        # every request is summed up in the app log
+        with self.assertLogs(self.app.logger, level='INFO') as logs:
+            response = self.client.get('/explore')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.assertTrue(any(re.search(r'GET main.explore 200: \d+ queries in', line) for line in logs.output))
+
+    def test_post_fragment_cache(self):
+        self.assertIn(b'post from user0', self.client.get('/user/user0').data)
+        self.assertEqual(len(self.app.local_stores['post_fragments']), 1)
+        self.client.get('/user/user0')
+        self.assertEqual(len(self.app.local_stores['post_fragments']), 1)
+
+        # fragments are rendered again once the author changes username
+        User.query.filter_by(username='user0').first().username = 'renamed'
+        db.session.commit()
+        data = self.client.get('/user/renamed').data
+        self.assertIn(b'/user/renamed', data)
+        self.assertNotIn(b'/user/user0', data)
+        self.assertEqual(len(self.app.local_stores['post_fragments']), 2)
+
+    def test_conditional_get(self):
+        response = self.client.get('/explore')
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get('/explore', headers={'If-None-Match': etag}).status_code, 304)
+
+        # new posts change the ETag
+        db.session.add(Post(body='new post', author=User.query.filter_by(username='user0').first(),
+                            timestamp=(datetime.utcnow() + timedelta(minutes=1))))
+        db.session.commit()
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'new post', response.data)
+
+        # renaming an author changes the ETag of the feeds that show its posts
+        etag = response.headers['ETag']
+        User.query.filter_by(username='user0').first().username = 'renamed'
+        db.session.commit()
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'renamed', response.data)
+
+        response = self.client.get('/notifications?since=0')
+        self.assertEqual(response.json, [])
+        self.assertEqual(self.client.get('/notifications?since=0',
+                                         headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+    def test_user_popup(self):
+        response = self.client.get('/user/user0/popup')
+        self.assertIn('max-age', response.headers['Cache-Control'])
+        self.assertIn(b'1 followers, 0 following', response.data)
+        self.assertIn(b'Unfollow', response.data)
+
+        # follow changes show up in the popup
+        User.query.filter_by(username='viewer').first().unfollow(User.query.filter_by(username='user0').first())
+        db.session.commit()
+        response = self.client.get('/user/user0/popup')
+        self.assertIn(b'0 followers, 0 following', response.data)
+        self.assertNotIn(b'Unfollow', response.data)
+        self.assertNotIn(b'Follow', self.client.get('/user/viewer/popup').data)
+
+        # unknown users are not given a version stamp
+        self.assertEqual(self.client.get('/user/nobody/popup').status_code, 404)
+        self.assertNotIn('profile:nobody', self.app.stamps.stamps)
+
+    def test_identity_only_requests(self):
+        # the logged in user comes from the user cache, so only the notifications are queried
+        self.count_queries('/notifications?since=0')
+        self.assertEqual(self.count_queries('/notifications?since=0'), 1)
+
+    def test_notification_stream(self):
+        self.app.config['NOTIFICATION_STREAM_TIMEOUT'] = 0.2
+        self.app.config['NOTIFICATION_STREAM_KEEPALIVE'] = 0.1
+        viewer = User.query.filter_by(username='viewer').first()
+        viewer.add_notification('unread_message_count', 1)
+        db.session.commit()
+        since = viewer.notifications.first().timestamp
+
+        # notifications are published to the subscribers of the user once committed
+        subscription = self.app.broker.subscribe(viewer.id)
+        viewer.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(json.loads(subscription.get(timeout=1))['data'], 2)
+        subscription.close()
+
+        # the stream starts with the notifications newer than the last event received
+        response = self.client.get('/notifications/stream', headers={'Last-Event-ID': str(since)})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [line for line in response.get_data(as_text=True).split('\n') if line.startswith('data: ')]
+        self.assertEqual([json.loads(line[6:])['data'] for line in events], [2])
+
+        # live notifications already sent on the stream, or older than them, are not sent again
+        response = self.client.get('/notifications/stream', headers={'Last-Event-ID': str(since)}, buffered=False)
+        for timestamp, data in ((since + 1, 3), (since + 1, 3), (since + 0.5, 4), (since + 2, 5)):
+            self.app.broker.publish(viewer.id, json.dumps({'name': 'unread_message_count', 'data': data,
+                                                           'timestamp': timestamp}))
+        events = [line for line in response.get_data(as_text=True).split('\n') if line.startswith('data: ')]
+        self.assertEqual([json.loads(line[6:])['data'] for line in events], [2, 3, 5])
+
+    def test_redis_broker(self):
+        # a worker listens to the notifications of all its streams on one pub/sub connection
+        broker = RedisBroker(mock.Mock())
+        s1, s2, s3 = broker.subscribe(1), broker.subscribe(1), broker.subscribe(2)
+        broker.redis.pubsub.assert_called_once_with(ignore_subscribe_messages=True)
+        broker._receive({'channel': b'notifications:1', 'data': b'hello'})
+        self.assertEqual((s1.get(timeout=0), s2.get(timeout=0), s3.get(timeout=0)), ('hello', 'hello', None))
+        s1.close()
+        s2.close()
+        broker._receive({'channel': b'notifications:1', 'data': b'hello again'})
+        self.assertEqual(list(broker.subscriptions), [2])
+
+    def test_constant_queries_per_page(self):
+        for url in ('/index', '/explore', '/user/user0'):
+            self.app.config['POSTS_PER_PAGE'] = 2
+            self.count_queries(url)
+            small_page = self.count_queries(url)
+            self.app.config['POSTS_PER_PAGE'] = 6
+            self.assertEqual(self.count_queries(url), small_page, url)
+
+
+class TranslatorStub(BaseHTTPRequestHandler):
+    """This class implements a local stand-in for the translator API, which records the texts it is asked for."""
+
+    def do_POST(self):
+        texts = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.texts += [text['Text'] for text in texts]
+        if texts[0]['Text'] == 'fail':
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps([{'translations': [{'text': text['Text'].upper()}]} for text in texts]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TranslationCacheCase(unittest.TestCase):
+    """This class implements a child class of unittest.TestCase to check the translation cache against a stub API."""
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), TranslatorStub)
+        self.server.texts = []
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def translate(self, text, source_language='en', dest_language='zh'):
+        response = self.client.post('/translate', data={'text': text, 'source_language': source_language,
+                                                        'dest_language': dest_language})
+        return response.get_json()['text']
+
+    def test_translation_cache(self):
+        self.assertEqual(self.translate('hello'), 'HELLO')
+        self.assertEqual(self.translate('hello'), 'HELLO')
+        self.assertEqual(self.server.texts, ['hello'])
+
+        # the language pair is part of the key, and failures are not cached
+        self.assertEqual(self.translate('hello', dest_language='fr'), 'HELLO')
+        self.assertTrue(self.translate('fail').startswith('Error'))
+        self.assertTrue(self.translate('fail').startswith('Error'))
+        self.assertEqual(self.server.texts, ['hello', 'hello', 'fail', 'fail'])
+        metrics = translation_metrics()
+        self.assertEqual((metrics['redis_hits'] + metrics['store_hits'], metrics['misses'], metrics['errors']),
+                         (1, 4, 2))
+
+        # cached translations are served without the API, even once it is no longer configured
+        self.app.config['MS_TRANSLATOR_KEY'] = None
+        self.assertEqual(self.translate('hello', dest_language='fr'), 'HELLO')
+        self.assertEqual(len(self.server.texts), 4)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file